@@ -10,15 +10,11 @@ if __name__ == "__main__":
         if file.endswith('.nc'):
             out = os.path.join(output_dir, file.split('.')[0])
             os.makedirs(out, exist_ok=True)
+            # 一次读取同时计算 TXx、TXn、ID、SU 与 CHE，按时间块扫描，无需合并 valid_time
             calculate.get_etccdi_stats(os.path.join(input_dir, file),var_name='t2m',output_dir=out,chunks={
-                'valid_time': -1,
+                'valid_time': 100,
                 'latitude': 71,
                 'longitude': 122
             },
-            time_dim='valid_time')
-            calculate.calculate_heatwave_events(os.path.join(input_dir,file),temp_var='t2m',threshold=350,out_dir=out,chunks={
-                'valid_time': -1,
-                'latitude': 71,
-                'longitude': 122
-            },
-            time_dim='valid_time')
+            time_dim='valid_time',
+            heatwave_threshold=350)
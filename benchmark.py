@@ -0,0 +1,26 @@
+import argparse
+from lun_wen.benchmark import GRID_SIZES, SERIES_YEARS, compare_benchmarks, run_benchmarks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="在合成立方体上对各指数函数计时")
+    parser.add_argument("--output", default="output/benchmark.json", help="结果 JSON 路径")
+    parser.add_argument("--baseline", default=None, help="基准结果 JSON，给出时列出变慢的项")
+    parser.add_argument("--tolerance", type=float, default=1.2, help="耗时超过基准的倍数视为变慢")
+    parser.add_argument("--functions", nargs="*", default=None, help="只测这些函数")
+    parser.add_argument("--repeat", type=int, default=3, help="重复次数")
+    parser.add_argument("--quick", action="store_true", help="只测最小网格和1年序列")
+    args = parser.parse_args()
+    run_benchmarks(
+        args.output,
+        grid_sizes=GRID_SIZES[:1] if args.quick else GRID_SIZES,
+        series_years=SERIES_YEARS[:1] if args.quick else SERIES_YEARS,
+        functions=args.functions,
+        repeat=args.repeat
+    )
+    if args.baseline:
+        regressions = compare_benchmarks(args.baseline, args.output, args.tolerance)
+        for r in regressions:
+            print(f"变慢 {r['function']:<26} {r['grid']} {r['years']}年 {r['chunks']} {r['baseline']:.3f} s → {r['current']:.3f} s ({r['ratio']:.2f}x)")
+        if not regressions:
+            print("未发现变慢的项")
@@ -0,0 +1,21 @@
+import sys
+from lun_wen.store import benchmark_backends, open_store
+
+
+if __name__ == "__main__":
+    # 用法：python benchmark_store.py ncs/1km/2003.nc [t2m]
+    path = sys.argv[1] if len(sys.argv) > 1 else "ncs/1km/2003.nc"
+    var = sys.argv[2] if len(sys.argv) > 2 else "t2m"
+    chunks = {"valid_time": 100, "latitude": 1024, "longitude": 1024}
+    with open_store(path, chunks=chunks) as ds:
+        encoding = {
+            var: {
+                'zlib': True,
+                'complevel': 4,
+                'chunksizes': tuple(ds[var].chunks[i][0] for i in range(ds[var].ndim)),
+                'shuffle': True,
+            }
+        }
+        results = benchmark_backends(ds[[var]], "output/benchmark", encoding, works=8, output_json="output/benchmark_store.json")
+    for backend, result in results.items():
+        print(f"{backend:<8} 写入 {result['write_MBps']:8.1f} MB/s  读取 {result['read_MBps']:8.1f} MB/s  大小 {result['size_MB']:8.1f} MB")
@@ -1,8 +1,11 @@
-import xarray as xr
-from dask.diagnostics.progress import ProgressBar
+import glob
+from lun_wen.cog import write_cog
+from lun_wen.quantile import histogram_quantile
+from lun_wen.virtual import build_index, open_virtual
 if __name__ == "__main__":
-    with xr.open_dataset("ncs/1km/merged.nc",engine="h5netcdf",chunks={"valid_time": -1,"latitude": 10,"longitude": 10}) as ds:
-        TX90p = ds['t2m'].quantile(0.9, dim="valid_time")
-        with ProgressBar():
-            TX90p.compute(num_workers=8)
-        TX90p.rio.to_raster("ncs/1km/1km-90p.tif")
+    # 各年份文件经虚拟索引拼接为一个 (valid_time, lat, lon) 数据集，直接按原生 (1, y, x) 分块流式读取
+    files = sorted(f for f in glob.glob("ncs/1km/*.nc") if not f.endswith("merged.nc"))
+    build_index(files, "t2m", "ncs/1km/index.json")
+    ds = open_virtual("ncs/1km/index.json")
+    TX90p = histogram_quantile(ds['t2m'], 0.9, dim="valid_time", works=8)
+    write_cog(TX90p, "ncs/1km/1km-90p.tif")
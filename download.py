@@ -1,10 +1,7 @@
-
-from lun_wen.download_data import download_era5_data
+from lun_wen.download_data import download_months
 
 
 if __name__ == "__main__":
-    # for year in range(2021, 2023):
-    #     for month in range(1, 13):
-    #         download_era5_data(year, month)
-    for month in range(8, 13):
-        download_era5_data(2022, month)
+    # 已完成的月份记录在 data/manifest.json 中，重复运行时跳过，中断的文件续传
+    months = [(year, month) for year in range(2021, 2023) for month in range(1, 13)]
+    download_months(months, out_dir="data", works=4)
@@ -0,0 +1,6 @@
+from lun_wen.ingest import ingest
+
+
+if __name__ == "__main__":
+    # 下载、换算裁剪、写入年份存储同时进行，逐月原始文件与下载清单保存在 data 中
+    ingest([2021, 2022], out_dir="ncs/ingest", shapefile="shp/China.shp", download_dir="data")
@@ -1,23 +1,14 @@
-from dask.diagnostics.progress import ProgressBar
-import xarray as xr
 import glob
+from lun_wen.virtual import build_index, open_virtual
+
+# 不再把各年份文件物理合并为 merged.nc，只记录各文件分块的字节范围，按索引直接读取原文件；
+# 90% 分位数见 calculate_90p.py
+INDEX = "ncs/1km/index.json"
 
 
 if __name__ == "__main__":
-    with xr.open_mfdataset(glob.glob("ncs/1km/*.nc"),engine="h5netcdf",concat_dim="valid_time",combine="nested",chunks={'valid_time': 100,"latitude":1024,"longitude":1024}) as ds:
-        encoding = {
-                "t2m": {
-                    'zlib': True,
-                    'complevel': 4,  # 平衡速度与压缩率
-                    'chunksizes': (100, 1024,1024),
-                    'shuffle': True,
-                },
-                'latitude': {'dtype': 'float32'},
-                'longitude': {'dtype': 'float32'},
-                'valid_time': {'dtype': 'float64'}
-            }
-        delayed = ds.to_netcdf("ncs/1km/merged.nc",encoding=encoding,engine='h5netcdf', compute=False)
-        with ProgressBar():
-            delayed.compute(num_workers=8)
-            TX90p = ds["t2m"].chunk({'valid_time': 1000,"latitude":"auto","longitude":"auto"}).quantile(0.9, dim="valid_time").compute()
-            TX90p.rio.to_raster("ncs/0.25/0.25-90p.tif")
+    files = sorted(f for f in glob.glob("ncs/1km/*.nc") if not f.endswith("merged.nc"))
+    build_index(files, "t2m", INDEX)
+    ds = open_virtual(INDEX)
+    print(f"已合并 {len(files)} 个文件：{ds.valid_time.values[0]} ~ {ds.valid_time.values[-1]}，{dict(ds.sizes)}")
+    print(f"索引：{INDEX}")
@@ -1,3 +1,12 @@
 from src.lun_wen.file_operation import copy_files_by_keyword
 if __name__ == "__main__":
-    copy_files_by_keyword(source_dir="calculated_data/0.25", dest_dir="data/0.25", suffix=".tif", key_words=["CHE", "SU", "ID", "TXx", "TXn"])
+    # 快速模式：文件系统支持时用写时复制克隆，否则并行复制；分拣结果记录在 manifest.csv
+    copy_files_by_keyword(
+        source_dir="calculated_data/0.25",
+        dest_dir="data/0.25",
+        suffix=".tif",
+        key_words=["CHE", "SU", "ID", "TXx", "TXn"],
+        fast=True,
+        link="reflink",
+        manifest="data/0.25/manifest.csv"
+    )
@@ -0,0 +1,220 @@
+from __future__ import annotations
+import numpy as np
+from numba import jit
+from .instrument import kernel as kernel_timer
+
+# xarray、dask.array 与 mask 在用到的函数中导入，导入 calculate、mannkendall 时只加载 numpy 与 numba
+
+# 块内核的数据块为这两种数据类型的 C 连续 (像元, time) 数组
+BLOCK_DTYPES = (np.float32, np.float64)
+# 已登记的块内核及其显式签名，见 precompile
+KERNELS = []
+
+
+def block_signatures(ret: str, *args: str) -> list[str]:
+    """块内核的显式签名：首个参数为 float32 或 float64 的 C 连续二维数据块，其余参数按 numba 类型名给出"""
+    return [f"{ret}({np.dtype(dtype).name}[:, ::1], {', '.join(args)})" for dtype in BLOCK_DTYPES]
+
+
+def block_kernel(ret: str, *args: str):
+    """
+    块内核装饰器：nopython、nogil 编译并缓存到磁盘（cache=True），同时登记显式签名。
+    导入时不编译，首次调用时按实际类型编译或从缓存加载；precompile 可提前按签名全部编译
+    参数：
+        ret  : 返回类型，如 "float64[:, ::1]"
+        args : 数据块之后各参数的 numba 类型名
+    """
+    def decorate(func):
+        kernel = jit(nopython=True, nogil=True, cache=True)(func)
+        KERNELS.append((kernel, block_signatures(ret, *args)))
+        return kernel
+    return decorate
+
+
+def precompile() -> int:
+    """
+    按显式签名编译全部已登记的块内核（已有磁盘缓存时直接加载），
+    供部署后或批量任务开始前预热，之后各进程首次调用即命中缓存
+    返回: 编译的签名数
+    """
+    from . import calculate, mannkendall  # 导入时登记各模块的块内核
+    count = 0
+    for kernel, signatures in KERNELS:
+        for signature in signatures:
+            kernel.compile(signature)
+            count += 1
+    return count
+
+
+def _as_block(block: np.ndarray) -> np.ndarray:
+    """转为内核签名接受的 C 连续数组，整型等其他类型转为 float64"""
+    if block.dtype not in BLOCK_DTYPES:
+        block = block.astype(np.float64)
+    return np.ascontiguousarray(block)
+
+
+def valid_pixels(da: xr.DataArray, time_dim: str, shapefile: str = "") -> xr.DataArray:
+    """
+    有效像元掩膜：落在矢量区域内的像元，不读取数据；没有矢量文件时全部为 True。
+    缺测像元在各数据块内按 NaN 剔除（见 _run_block、_run_scan），打包与不打包的结果相同
+    参数：
+        da        : 输入数据
+        time_dim  : 时间维度名
+        shapefile : 区域矢量文件，为空时只按缺测判断
+    """
+    import xarray as xr
+    from .mask import grid_mask
+    template = da.isel({time_dim: 0}, drop=True)
+    valid = xr.DataArray(np.ones(template.shape, dtype=bool), dims=template.dims, coords=template.coords)
+    if shapefile != "":
+        if valid.rio.crs is None:
+            valid = valid.rio.write_crs("EPSG:4326")
+        region = grid_mask(valid, shapefile)
+        valid = valid & xr.DataArray(region, dims=(valid.rio.y_dim, valid.rio.x_dim))
+    return valid
+
+
+def _missing(block: np.ndarray) -> np.ndarray:
+    """(像元, time) 数据块中整段均为缺测的像元"""
+    if block.dtype.kind != "f":
+        return np.zeros(block.shape[0], dtype=bool)
+    return np.isnan(block).all(axis=-1)
+
+
+def _run_block(arr: np.ndarray, valid: np.ndarray | None = None, kernel=None, args: tuple = ()) -> np.ndarray:
+    """
+    把 (..., time) 数据块展平为 (像元, time) 后整块交给 numba 内核
+    给出 valid 时只把区域内且本块不全为缺测的像元聚成致密数组交给内核，结果再散回网格，其余像元为 NaN；
+    块内核对含缺测的序列输出 NaN，因此与不打包的结果相同
+    """
+    shape = arr.shape[:-1]
+    block = arr.reshape(-1, arr.shape[-1])
+    if valid is None:
+        block = _as_block(block)
+        with kernel_timer():
+            out = kernel(block, *args)
+        return out.reshape(shape + out.shape[1:])
+    keep = np.broadcast_to(valid, shape).reshape(-1) & ~_missing(block)
+    block = _as_block(block[keep])
+    with kernel_timer():
+        packed = kernel(block, *args)
+    out = np.full((len(keep),) + packed.shape[1:], np.nan)
+    out[keep] = packed
+    return out.reshape(shape + out.shape[1:])
+
+
+def apply_block(
+        kernel,
+        da: xr.DataArray,
+        time_dim: str,
+        args: tuple = (),
+        output_dim: str | None = None,
+        output_size: int = 1,
+        valid: xr.DataArray | None = None
+    ) -> xr.DataArray:
+    """
+    以数据块为单位调用块内核，替代 apply_ufunc(vectorize=True) 的逐像元分发
+    参数：
+        kernel      : 块内核，输入 (像元, time) 数组，返回 (像元,) 或 (像元, output_size)
+        da          : 输入数据
+        time_dim    : 时间维度名，必须为单一分块
+        args        : 传给内核的标量参数
+        output_dim  : 多输出时新增的维度名，为None时内核返回 (像元,)
+        output_size : 多输出维度长度
+        valid       : 有效像元掩膜（见 valid_pixels），给出时内核只处理有效像元
+    """
+    import xarray as xr
+    output_core_dims = [[output_dim]] if output_dim else [[]]
+    dask_gufunc_kwargs = {"output_sizes": {output_dim: output_size}} if output_dim else {}
+    inputs = (da,) if valid is None else (da, valid)
+    return xr.apply_ufunc(
+        _run_block,
+        *inputs,
+        input_core_dims=[[time_dim]] + [[]] * (len(inputs) - 1),
+        output_core_dims=output_core_dims,
+        kwargs={"kernel": kernel, "args": args},
+        dask="parallelized",
+        output_dtypes=[float],
+        dask_gufunc_kwargs=dask_gufunc_kwargs
+    )
+
+
+def _run_scan(block: np.ndarray, state: np.ndarray, valid: np.ndarray | None = None, kernel=None, args: tuple = ()) -> np.ndarray:
+    shape = state.shape
+    block = block.reshape(-1, block.shape[-1])
+    state = state.reshape(-1, shape[-1]).copy()
+    if valid is None:
+        block = _as_block(block)
+        with kernel_timer():
+            return kernel(block, state, *args).reshape(shape)
+    # 区域外像元保持初始状态，不进入内核
+    inside = np.broadcast_to(valid, shape[:-1] + (1,)).reshape(-1)
+    missing = inside & _missing(block)
+    keep = inside & ~missing
+    with kernel_timer():
+        state[keep] = kernel(_as_block(block[keep]), np.ascontiguousarray(state[keep]), *args)
+        if missing.any():
+            # 扫描内核遇到缺测即标记该像元并停止更新，本块全为缺测的像元只需交给内核一个缺测时刻
+            gap = np.full((int(missing.sum()), 1), np.nan, dtype=_as_block(block[:0]).dtype)
+            state[missing] = kernel(gap, np.ascontiguousarray(state[missing]), *args)
+    return state.reshape(shape)
+
+
+def scan_block(
+        kernel,
+        da: xr.DataArray,
+        time_dim: str,
+        init: np.ndarray | xr.DataArray,
+        args: tuple = (),
+        state_dim: str = "state",
+        valid: xr.DataArray | None = None
+    ) -> xr.DataArray:
+    """
+    沿时间分块顺序扫描并携带逐像元状态，时间维无需合并为单一分块
+    参数：
+        kernel    : 扫描内核，输入 (像元, time) 数据块和 (像元, k) 状态，返回更新后的状态
+        da        : 输入数据，可按时间任意分块
+        time_dim  : 时间维度名
+        init      : 长度为 k 的初始状态，或逐像元的 (..., k) 初始状态
+        args      : 传给内核的标量参数
+        state_dim : 状态维度名
+        valid     : 有效像元掩膜（见 valid_pixels），无效像元不参与扫描、保持初始状态
+    返回: 扫描完全部时间块后的 (..., k) 状态
+    """
+    import dask.array as dask_array
+    import xarray as xr
+    da = da.transpose(..., time_dim)
+    dims = da.dims[:-1] + (state_dim,)
+    coords = {name: coord for name, coord in da.coords.items() if time_dim not in coord.dims}
+    if isinstance(init, xr.DataArray):
+        init = init.transpose(*da.dims[:-1], state_dim).astype(np.float64).data
+    else:
+        init = np.asarray(init, dtype=np.float64)
+    shape = da.shape[:-1] + init.shape[-1:]
+    if valid is not None:
+        # 末尾补长度为1的维度，与数据块、状态块按维度对齐
+        valid = valid.broadcast_like(da.isel({time_dim: 0}, drop=True)).transpose(*da.dims[:-1]).values[..., None]
+    if not isinstance(da.data, dask_array.Array):
+        state = np.broadcast_to(np.asarray(init), shape)
+        return xr.DataArray(_run_scan(np.asarray(da.data), state, valid, kernel, args), dims=dims, coords=coords)
+    data = da.data
+    chunks = data.chunks[:-1] + (init.shape[-1:],)
+    if valid is not None:
+        valid = dask_array.from_array(valid, chunks=data.chunks[:-1] + (1,))
+    if init.ndim == 1:
+        state = dask_array.broadcast_to(dask_array.from_array(init, chunks=-1), shape, chunks=chunks)
+    else:
+        state = dask_array.asarray(init).rechunk(chunks)
+    # 每个时间块依赖上一块的状态，同一空间块按时间顺序执行，内存只与单个分块有关
+    for i in range(data.numblocks[-1]):
+        block = data.blocks[(slice(None),) * (data.ndim - 1) + (i,)]
+        inputs = (block, state) if valid is None else (block, state, valid)
+        state = dask_array.map_blocks(
+            _run_scan,
+            *inputs,
+            kernel=kernel,
+            args=args,
+            dtype=np.float64,
+            chunks=state.chunks
+        )
+    return xr.DataArray(state, dims=dims, coords=coords)
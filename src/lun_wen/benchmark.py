@@ -0,0 +1,226 @@
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from importlib import metadata
+import dask
+import numba
+import numpy as np
+import pandas as pd
+import rioxarray  # 注册 .rio 访问器
+import xarray as xr
+from . import calculate, mannkendall
+from .store import tiffs_to_nc
+
+GRID_SIZES = ((64, 64), (256, 256))
+SERIES_YEARS = (1, 3)
+# 空间分块边长与时间分块长度；时间维需为单一分块的函数统一使用 -1
+CHUNKINGS = ({"valid_time": 100, "space": 64}, {"valid_time": -1, "space": 128})
+
+
+def synthetic_cube(
+        shape: tuple[int, int, int] = (365, 64, 64),
+        seed: int = 0,
+        start: str = "2001-01-01",
+        nan_fraction: float = 0.2,
+        var: str = "tm"
+    ) -> xr.Dataset:
+    """
+    生成确定性的类 ERA5 日最高气温立方体 (valid_time, latitude, longitude)，单位 0.1°C
+    含季节循环、逐像元线性趋势、一阶自相关噪声与纬度梯度，数值取整到 0.1°C 因而有大量并列值；
+    网格一角按 nan_fraction 设为全时段缺测，模拟海洋或区域外像元
+    参数：
+        shape        : (时间步数, 纬度格点数, 经度格点数)
+        seed         : 随机种子，相同参数生成完全相同的数据
+        start        : 起始日期
+        nan_fraction : 缺测像元比例
+        var          : 变量名
+    """
+    nt, ny, nx = shape
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(start, periods=nt, freq="D")
+    lat = np.linspace(54, 18, ny, dtype=np.float64)
+    lon = np.linspace(73, 135, nx, dtype=np.float64)
+    doy = times.dayofyear.values
+    season = 120 * np.sin(2 * np.pi * (doy - 105) / 365.25)
+    base = 330 - 4 * (lat - 18)[:, None] + np.zeros((ny, nx))
+    trend = rng.uniform(-0.002, 0.004, (ny, nx))
+    noise = np.empty((nt, ny, nx), dtype=np.float32)
+    noise[0] = rng.normal(0, 30, (ny, nx))
+    for t in range(1, nt):
+        noise[t] = 0.6 * noise[t - 1] + rng.normal(0, 24, (ny, nx))
+    data = np.round(base + season[:, None, None] + trend * np.arange(nt)[:, None, None] + noise).astype(np.float32)
+    # 缺测区域为网格东北角的扇形，在时间上固定
+    yy, xx = np.meshgrid(np.linspace(0, 1, ny), np.linspace(0, 1, nx), indexing="ij")
+    ocean = (yy ** 2 + (1 - xx) ** 2) < np.sqrt(nan_fraction * 4 / np.pi) ** 2 if nan_fraction > 0 else np.zeros((ny, nx), bool)
+    data[:, ocean] = np.nan
+    ds = xr.Dataset(
+        {var: (("valid_time", "latitude", "longitude"), data, {"units": "0.1°C"})},
+        coords={
+            "valid_time": times,
+            "latitude": ("latitude", lat, {"standard_name": "latitude", "units": "degrees_north"}),
+            "longitude": ("longitude", lon, {"standard_name": "longitude", "units": "degrees_east"}),
+        }
+    )
+    return ds.rio.write_crs("EPSG:4326")
+
+
+def _write_tiffs(ds: xr.Dataset, var: str, out_dir: str) -> None:
+    """把立方体按日写为 %Y%m%d.tif，供 tiffs_to_nc 基准使用"""
+    os.makedirs(out_dir, exist_ok=True)
+    da = ds[var].rename({"latitude": "y", "longitude": "x"}).fillna(-9999)
+    for t in range(da.sizes["valid_time"]):
+        day = da.isel(valid_time=t)
+        day.rio.to_raster(os.path.join(out_dir, f"{pd.Timestamp(day.valid_time.values):%Y%m%d}.tif"), dtype="float32")
+
+
+def _cases(path: str, monthly: str, tiffs: str, work: str, chunks: dict, single: dict) -> dict:
+    """各被测函数及其实际使用的分块，时间维需为单一分块的函数使用 single"""
+    return {
+        "get_etccdi_stats": (lambda: calculate.get_etccdi_stats(path, "tm", work, chunks=chunks, heatwave_threshold=350), chunks),
+        "annual_etccdi_cube": (lambda: calculate.annual_etccdi_cube(path, "tm", os.path.join(work, "cube"), chunks=chunks, heatwave_threshold=350), chunks),
+        "calculate_heatwave_events": (lambda: calculate.calculate_heatwave_events(path, work, "tm", threshold=350, chunks=chunks), chunks),
+        "tx90p_count": (lambda: calculate.tx90p_count(path, work, "tm", chunks=single), single),
+        "mannkendall": (lambda: mannkendall.mannkendall(monthly, time_dim="valid_time", chunks=single, var_name="tm", out_dir=work), single),
+        "tiffs_to_nc": (lambda: tiffs_to_nc(tiffs, os.path.join(work, "tiffs.nc"), "tm", chunks=chunks["latitude"]), {"latitude": chunks["latitude"], "longitude": chunks["longitude"]}),
+    }
+
+
+def _environment() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, cwd=os.path.dirname(__file__)
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    try:
+        version = metadata.version("lun-wen")
+    except metadata.PackageNotFoundError:
+        version = None
+    return {
+        "version": version,
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "numba": numba.__version__,
+        "dask": dask.__version__,
+        "xarray": xr.__version__,
+    }
+
+
+def run_benchmarks(
+        output_json: str = "output/benchmark.json",
+        grid_sizes: tuple = GRID_SIZES,
+        series_years: tuple = SERIES_YEARS,
+        chunkings: tuple = CHUNKINGS,
+        functions: list[str] | None = None,
+        repeat: int = 3,
+        seed: int = 0
+    ) -> dict:
+    """
+    在合成立方体上对各指数函数计时，结果写入 JSON，不同版本的结果可用 compare_benchmarks 对比
+    每种网格与序列长度只生成一次数据；首次调用前先在小立方体上运行一遍，排除 numba 编译时间；
+    每项取 repeat 次中的最短耗时
+    参数：
+        output_json  : 结果 JSON 路径
+        grid_sizes   : 网格大小 ((纬度, 经度), ...)
+        series_years : 序列年数
+        chunkings    : 分块方案，见 CHUNKINGS
+        functions    : 只测这些函数，为None时测全部
+        repeat       : 重复次数
+        seed         : 随机种子
+    返回: {"environment": {...}, "results": [...]}
+    """
+    results = []
+    # 不受时间分块影响的函数在相同实际分块下只测一次
+    done = set()
+    with tempfile.TemporaryDirectory() as tmp:
+        cases = [("warmup", (16, 16), 1, chunkings[0])]
+        cases += [("run", g, y, c) for g, y, c in itertools.product(grid_sizes, series_years, chunkings)]
+        for kind, (ny, nx), years, chunking in cases:
+            start = pd.Timestamp("2001-01-01")
+            nt = (pd.Timestamp(f"{2001 + years}-01-01") - start).days
+            case_dir = os.path.join(tmp, f"{ny}x{nx}-{years}y")
+            path = os.path.join(case_dir, "cube.nc")
+            monthly = os.path.join(case_dir, "monthly.nc")
+            tiffs = os.path.join(case_dir, "tiffs")
+            if not os.path.exists(path):
+                os.makedirs(case_dir)
+                ds = synthetic_cube((nt, ny, nx), seed=seed)
+                ds.to_netcdf(path, engine="h5netcdf")
+                ds.resample(valid_time="MS").mean().to_netcdf(monthly, engine="h5netcdf")
+                _write_tiffs(ds, "tm", tiffs)
+            space = chunking["space"]
+            chunks = {"valid_time": chunking["valid_time"], "latitude": space, "longitude": space}
+            single = {"valid_time": -1, "latitude": space, "longitude": space}
+            for name, (run, used) in _cases(path, monthly, tiffs, os.path.join(case_dir, "out"), chunks, single).items():
+                key = (name, ny, nx, years, json.dumps(used, sort_keys=True))
+                if functions is not None and name not in functions or key in done:
+                    continue
+                os.makedirs(os.path.join(case_dir, "out"), exist_ok=True)
+                seconds = []
+                for _ in range(1 if kind == "warmup" else repeat):
+                    begin = time.perf_counter()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        run()
+                    seconds.append(time.perf_counter() - begin)
+                if kind == "warmup":
+                    continue
+                done.add(key)
+                results.append({
+                    "function": name,
+                    "grid": [ny, nx],
+                    "years": years,
+                    "time_steps": nt,
+                    "chunks": used,
+                    "seconds": min(seconds),
+                    "all_seconds": seconds,
+                    "pixel_steps_per_s": nt * ny * nx / min(seconds),
+                })
+                print(f"{name:<26} {ny}x{nx} {years}年 {used} {min(seconds):8.3f} s")
+    report = {"environment": _environment(), "results": results}
+    os.makedirs(os.path.dirname(os.path.abspath(output_json)), exist_ok=True)
+    with open(output_json, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    return report
+
+
+def _case_key(result: dict) -> tuple:
+    return result["function"], tuple(result["grid"]), result["years"], json.dumps(result["chunks"], sort_keys=True)
+
+
+def compare_benchmarks(baseline_json: str, current_json: str, tolerance: float = 1.2) -> list[dict]:
+    """
+    对比两次基准结果，列出耗时超过基准 tolerance 倍的项
+    返回: [{"function", "grid", "years", "chunks", "baseline", "current", "ratio"}, ...]
+    """
+    with open(baseline_json) as f:
+        baseline = {_case_key(r): r for r in json.load(f)["results"]}
+    with open(current_json) as f:
+        current = json.load(f)["results"]
+    regressions = []
+    for result in current:
+        old = baseline.get(_case_key(result))
+        if old is None:
+            continue
+        ratio = result["seconds"] / old["seconds"]
+        if ratio > tolerance:
+            regressions.append({
+                "function": result["function"],
+                "grid": result["grid"],
+                "years": result["years"],
+                "chunks": result["chunks"],
+                "baseline": old["seconds"],
+                "current": result["seconds"],
+                "ratio": ratio,
+            })
+    return regressions
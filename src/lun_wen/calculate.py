@@ -1,219 +1,752 @@
+from __future__ import annotations
 from pathlib import Path
-import xarray as xr
 import os
-from dask.diagnostics.progress import ProgressBar
 from numba import jit
 import numpy as np
+from ._blocks import apply_block, block_kernel, scan_block, valid_pixels
+from .instrument import stage
 
-@jit(nopython=True)
-def _max(arr:np.ndarray):
-    if np.isnan(arr).any():
-        return np.nan
-    max = arr[0]
-    for value in arr:
-        if value > max:
-            max = value
-    return max
+# xarray、pandas 与读写模块（连带 dask、rioxarray）在各函数中导入，导入本模块只需 numpy 与 numba
 
-@jit(nopython=True)
-def _min(arr:np.ndarray):
-    if np.isnan(arr).any():
-        return np.nan
-    min = arr[0]
-    for value in arr:
-        if value < min:
-            min = value
-    return min
+# TXPD 为超过全序列百分位的天数，与 tx90p_count 输出的 ETCCDI TX90p（各年超过日历日阈值的天数百分比）不同
+ETCCDI_INDICES = ("TXx", "TXn", "ID", "SU", "CHE", "TXPD")
 
-@jit(nopython=True)
-def _summerdays(arr:np.ndarray,threshold:float):
-    if np.isnan(arr).any():
-        return np.nan
-    count = 0.0
+HEATWAVE_METRICS = ("HWN", "HWF", "HWD", "HWM", "HWA")
+
+# 年指数立方体中各指数的单位
+ANNUAL_UNITS = {"TXx": "0.1°C", "TXn": "0.1°C", "ID": "days", "SU": "days", "CHE": "events", "TXPD": "days"}
+
+# 扫描状态：TXx、TXn、ID、SU、当前连续高温天数、高温事件数、缺测标记
+_ETCCDI_INIT = np.array([-np.inf, np.inf, 0.0, 0.0, 0.0, 0.0, 0.0])
+# 扫描状态：当前过程天数、温度和、最高温，HWN、HWF、HWD、各事件均温之和、HWA，缺测标记、阈值
+_HEATWAVE_INIT = np.array([0.0, 0.0, -np.inf, 0.0, 0.0, 0.0, 0.0, -np.inf, 0.0, np.nan])
+
+@jit(nopython=True, cache=True)
+def _etccdi_update(arr:np.ndarray,state:np.ndarray,summer_threshold:float,winter_threshold:float,heatwave_threshold:float,min_duration:int):
+    """
+    用一段时间序列更新累计状态，连续高温天数跨时间块延续
+    heatwave_threshold 为 NaN 时不统计高温事件
+    """
+    if state[6] > 0:
+        return
     for value in arr:
-        if value > threshold:
-            count += 1
-    return count
+        if np.isnan(value):
+            state[6] = 1
+            return
+        if value > state[0]:
+            state[0] = value
+        if value < state[1]:
+            state[1] = value
+        if value < winter_threshold:
+            state[2] += 1
+        if value > summer_threshold:
+            state[3] += 1
+        if value > heatwave_threshold:
+            state[4] += 1
+            if state[4] == min_duration:
+                state[5] += 1
+        else:
+            state[4] = 0
+
+@jit(nopython=True, cache=True)
+def _etccdi_finish(state:np.ndarray,heatwave:bool,out:np.ndarray):
+    out[:] = np.nan
+    if state[6] > 0:
+        return
+    out[:4] = state[:4]
+    if heatwave:
+        out[4] = state[5]
 
-@jit(nopython=True)
-def _winterdays(arr:np.ndarray,threshold:float):
+@jit(nopython=True, cache=True)
+def _etccdi(arr:np.ndarray,summer_threshold:float,winter_threshold:float,heatwave_threshold:float,min_duration:int,percentile:float):
+    """
+    单次遍历像元时间序列，同时计算 TXx、TXn、ID、SU、CHE、TXPD
+    heatwave_threshold、percentile 为 NaN 时跳过对应指数（结果为 NaN）
+    """
+    out = np.full(6, np.nan)
     if np.isnan(arr).any():
+        return out
+    state = _ETCCDI_INIT.copy()
+    _etccdi_update(arr,state,summer_threshold,winter_threshold,heatwave_threshold,min_duration)
+    _etccdi_finish(state,not np.isnan(heatwave_threshold),out)
+    if not np.isnan(percentile):
+        percentValue = np.percentile(arr,percentile)
+        out[5] = np.sum(arr > percentValue)
+    return out
+
+@block_kernel("float64[:, ::1]", "float64", "float64", "float64", "int64", "float64")
+def _etccdi_block(block:np.ndarray,summer_threshold:float,winter_threshold:float,heatwave_threshold:float,min_duration:int,percentile:float):
+    out = np.empty((block.shape[0], 6))
+    for i in range(block.shape[0]):
+        out[i] = _etccdi(block[i],summer_threshold,winter_threshold,heatwave_threshold,min_duration,percentile)
+    return out
+
+@block_kernel("float64[:, ::1]", "float64[:, ::1]", "float64", "float64", "float64", "int64")
+def _etccdi_scan(block:np.ndarray,state:np.ndarray,summer_threshold:float,winter_threshold:float,heatwave_threshold:float,min_duration:int):
+    for i in range(block.shape[0]):
+        _etccdi_update(block[i],state[i],summer_threshold,winter_threshold,heatwave_threshold,min_duration)
+    return state
+
+@block_kernel("float64[:, ::1]", "boolean")
+def _etccdi_finish_block(state:np.ndarray,heatwave:bool):
+    out = np.empty((state.shape[0], 6))
+    for i in range(state.shape[0]):
+        _etccdi_finish(state[i],heatwave,out[i])
+    return out
+
+@jit(nopython=True, cache=True)
+def _close_event(state:np.ndarray,min_duration:int):
+    """结束当前高温过程，持续天数达到 min_duration 时计入各项指标"""
+    if state[0] >= min_duration:
+        state[3] += 1
+        state[4] += state[0]
+        if state[0] > state[5]:
+            state[5] = state[0]
+        state[6] += state[1] / state[0]
+        if state[2] > state[7]:
+            state[7] = state[2]
+    state[0] = 0
+    state[1] = 0
+    state[2] = -np.inf
+
+@block_kernel("float64[:, ::1]", "float64[:, ::1]", "int64")
+def _heatwave_scan(block:np.ndarray,state:np.ndarray,min_duration:int):
+    """
+    游程扫描高温过程，阈值取自状态末位（可逐像元不同），跨时间块延续未结束的高温过程
+    """
+    for i in range(block.shape[0]):
+        if state[i, 8] > 0:
+            continue
+        threshold = state[i, 9]
+        for val in block[i]:
+            if np.isnan(val):
+                state[i, 8] = 1
+                break
+            if val > threshold:
+                state[i, 0] += 1
+                state[i, 1] += val
+                if val > state[i, 2]:
+                    state[i, 2] = val
+            else:
+                _close_event(state[i],min_duration)
+    return state
+
+@block_kernel("float64[:, ::1]", "int64")
+def _heatwave_finish_block(state:np.ndarray,min_duration:int):
+    """由扫描状态得到 HWN、HWF、HWD、HWM、HWA，无高温过程时 HWM、HWA 为 NaN"""
+    out = np.full((state.shape[0], 5), np.nan)
+    for i in range(state.shape[0]):
+        current = state[i].copy()
+        if current[8] > 0 or np.isnan(current[9]):
+            continue
+        _close_event(current,min_duration)
+        out[i, 0] = current[3]
+        out[i, 1] = current[4]
+        out[i, 2] = current[5]
+        if current[3] > 0:
+            out[i, 3] = current[6] / current[3]
+            out[i, 4] = current[7]
+    return out
+
+def _heatwave_suite(da:xr.DataArray,threshold:float | xr.DataArray,min_duration:int,time_dim:str,valid:xr.DataArray | None=None) -> xr.DataArray:
+    """一次游程扫描得到全部高温过程指标，threshold 可为常数或逐像元阈值"""
+    import xarray as xr
+    if isinstance(threshold, xr.DataArray):
+        init = xr.concat(
+            [xr.full_like(threshold, value, dtype=float) for value in _HEATWAVE_INIT[:-1]] + [threshold.astype(float)],
+            dim="state"
+        ).drop_vars("quantile", errors="ignore")
+    else:
+        init = _HEATWAVE_INIT.copy()
+        init[-1] = threshold
+    # 标量参数按内核签名的类型传入，首次调用直接命中编译缓存
+    state = scan_block(_heatwave_scan, da, time_dim, init, args=(int(min_duration),), valid=valid)
+    return apply_block(
+        _heatwave_finish_block,
+        state,
+        "state",
+        args=(int(min_duration),),
+        output_dim="metric",
+        output_size=len(HEATWAVE_METRICS),
+        valid=valid
+    ).assign_coords(metric=list(HEATWAVE_METRICS))
+
+@jit(nopython=True, cache=True)
+def _lerp(a:float,b:float,t:float):
+    # 与 numpy 线性插值百分位的写法一致
+    if t >= 0.5:
+        return b - (b - a) * (1 - t)
+    return a + (b - a) * t
+
+@jit(nopython=True, cache=True)
+def _kth_union(r:np.ndarray,nr:int,b:np.ndarray,nb:int,k:int):
+    """两个有序数组并集中第 k 小（从0计）的值，b 很短（窗口内不超过 window 个）"""
+    for t in range(max(0, k + 1 - nr), min(nb, k + 1) + 1):
+        rn = k + 1 - t
+        if t > 0 and rn < nr and b[t - 1] > r[rn]:
+            continue
+        if rn > 0 and t < nb and r[rn - 1] > b[t]:
+            continue
+        if t == 0:
+            return r[rn - 1]
+        if rn == 0:
+            return b[t - 1]
+        return max(b[t - 1], r[rn - 1])
+    return np.nan
+
+@jit(nopython=True, cache=True)
+def _union_percentile(r:np.ndarray,nr:int,b:np.ndarray,nb:int,percentile:float):
+    """
+    两个有序数组并集的百分位，采用 climdex 使用的 Hyndman-Fan 第8类估计
+    （与 np.percentile(method="median_unbiased") 一致）
+    """
+    n = nr + nb
+    if n == 0:
         return np.nan
-    count = 0.0
-    for value in arr:
-        if value < threshold:
-            count += 1
-    return count
+    p = percentile / 100.0
+    # 第8类的位置 (n + 1/3)p + 1/3，换为从0计并截断到样本范围内
+    h = (n + 1.0 / 3.0) * p + 1.0 / 3.0 - 1.0
+    if h <= 0:
+        return _kth_union(r, nr, b, nb, 0)
+    lo = int(np.floor(h))
+    if lo + 1 >= n:
+        return _kth_union(r, nr, b, nb, n - 1)
+    return _lerp(_kth_union(r, nr, b, nb, lo), _kth_union(r, nr, b, nb, lo + 1), h - lo)
+
+@jit(nopython=True, cache=True)
+def _merge_update(s:np.ndarray,ns:int,out:np.ndarray,nout:int,inc:np.ndarray,ninc:int,dest:np.ndarray):
+    """
+    有序窗口增量更新：从 s 中移除有序的 out，并归并有序的 inc，结果写入 dest
+    单次线性扫描，避免每个日历日重新排序
+    """
+    j = 0
+    l = 0
+    k = 0
+    for i in range(ns):
+        v = s[i]
+        if j < nout and v == out[j]:
+            j += 1
+            continue
+        while l < ninc and inc[l] <= v:
+            dest[k] = inc[l]
+            l += 1
+            k += 1
+        dest[k] = v
+        k += 1
+    while l < ninc:
+        dest[k] = inc[l]
+        l += 1
+        k += 1
+    return k
+
+@jit(nopython=True, cache=True)
+def _block_window(base:np.ndarray,src:int,day:int,half_window:int,wrap:bool,dest:np.ndarray):
+    """
+    基准期第 src 年数据中落入日历日 day 滑动窗口的值，升序写入 dest。
+    wrap 为 True 时包括窗口越过年界的部分：这些时刻在相邻年份的窗口中，对应本年年初或年末的日历日
+    """
+    n = 0
+    for q in range(day - half_window, day + half_window + 1):
+        if (q < 0 or q >= 365) and not wrap:
+            continue
+        value = base[src * 365 + q % 365]
+        if not np.isnan(value):
+            dest[n] = value
+            n += 1
+    dest[:n] = np.sort(dest[:n])
+    return n
 
-@jit(nopython=True)
-def _precentile(arr: np.ndarray,percentile:float):
+@jit(nopython=True, cache=True)
+def _tx90p(arr:np.ndarray,year_pos:np.ndarray,cal_index:np.ndarray,doy_ptr:np.ndarray,doy_steps:np.ndarray,base_start:int,base_end:int,percentile:float,half_window:int):
+    """
+    ETCCDI TX90p：按日历日 5 日滑动窗口求基准期百分位阈值，
+    基准期内年份采用 bootstrap：依次用其余每个基准年的数据替换当年数据，在替换后的序列上重新取窗口求阈值
+    返回各年超过阈值的天数百分比
+    """
+    nyears = cal_index.shape[0]
+    out = np.full(nyears, np.nan)
     if np.isnan(arr).any():
-        return np.nan
-    percentValue = np.percentile(arr,percentile)
-    return np.sum(arr > percentValue)
+        return out
+    nb = base_end - base_start + 1
+    width = 2 * half_window + 1
+    base = np.full(nb * 365, np.nan)
+    for r in range(nb):
+        for d in range(365):
+            t = cal_index[base_start + r, d]
+            if t >= 0:
+                base[r * 365 + d] = arr[t]
+    # 各基准年数据在当前日历日窗口中的值（升序），含与不含越过年界的部分
+    inner = np.empty((nb, width))
+    inner_n = np.zeros(nb, dtype=np.int64)
+    wrapped = np.empty((nb, width))
+    wrapped_n = np.zeros(nb, dtype=np.int64)
+    window = np.empty(nb * width)
+    buffer = np.empty(nb * width)
+    reduced = np.empty(nb * width)
+    outgoing = np.empty(nb)
+    incoming = np.empty(nb)
+    # 首个日历日的窗口按序列位置取，含上一年末尾的几天
+    ns = 0
+    for r in range(nb):
+        for o in range(-half_window, half_window + 1):
+            idx = r * 365 + o
+            if 0 <= idx < len(base) and not np.isnan(base[idx]):
+                window[ns] = base[idx]
+                ns += 1
+    window[:ns] = np.sort(window[:ns])
+    exceed = np.zeros(nyears)
+    days = np.zeros(nyears)
+    for d in range(365):
+        if d > 0:
+            # 窗口右移一天：每个基准年移出 d-half_window-1、移入 d+half_window
+            nout = 0
+            ninc = 0
+            for r in range(nb):
+                idx = r * 365 + d - half_window - 1
+                if 0 <= idx < len(base) and not np.isnan(base[idx]):
+                    outgoing[nout] = base[idx]
+                    nout += 1
+                idx = r * 365 + d + half_window
+                if 0 <= idx < len(base) and not np.isnan(base[idx]):
+                    incoming[ninc] = base[idx]
+                    ninc += 1
+            outgoing[:nout] = np.sort(outgoing[:nout])
+            incoming[:ninc] = np.sort(incoming[:ninc])
+            ns = _merge_update(window, ns, outgoing, nout, incoming, ninc, buffer)
+            window, buffer = buffer, window
+        for r in range(nb):
+            inner_n[r] = _block_window(base, r, d, half_window, False, inner[r])
+            wrapped_n[r] = _block_window(base, r, d, half_window, True, wrapped[r])
+        threshold = _union_percentile(window, ns, incoming, 0, percentile)
+        for i in range(doy_ptr[d], doy_ptr[d + 1]):
+            t = doy_steps[i]
+            y = year_pos[t]
+            r = y - base_start
+            days[y] += 1
+            if r < 0 or r >= nb or nb == 1:
+                if arr[t] > threshold:
+                    exceed[y] += 1
+                continue
+            # 窗口越过年界的部分落在第 r 年数据中的前提是该侧的相邻年份也在基准期内
+            wrap = (d - half_window < 0 and r + 1 < nb) or (d + half_window >= 365 and r > 0)
+            rows, rows_n = (wrapped, wrapped_n) if wrap else (inner, inner_n)
+            # bootstrap：从窗口中去掉第 r 年数据的贡献，依次换上其余基准年在相同位置的数据，取超限频率均值
+            nr = _merge_update(window, ns, rows[r], rows_n[r], incoming, 0, reduced)
+            hits = 0.0
+            for other in range(nb):
+                if other == r:
+                    continue
+                if arr[t] > _union_percentile(reduced, nr, rows[other], rows_n[other], percentile):
+                    hits += 1
+            exceed[y] += hits / (nb - 1)
+    for y in range(nyears):
+        if days[y] > 0:
+            out[y] = exceed[y] / days[y] * 100
+    return out
 
-def get_etccdi_stats(nc_path:str, var_name:str,output_dir:str,chunks :int | dict =512,time_dim:str='valid_time'):
+@block_kernel("float64[:, ::1]", "int64[::1]", "int64[:, ::1]", "int64[::1]", "int64[::1]", "int64", "int64", "float64", "int64")
+def _tx90p_block(block:np.ndarray,year_pos:np.ndarray,cal_index:np.ndarray,doy_ptr:np.ndarray,doy_steps:np.ndarray,base_start:int,base_end:int,percentile:float,half_window:int):
+    out = np.empty((block.shape[0], cal_index.shape[0]))
+    for i in range(block.shape[0]):
+        out[i] = _tx90p(block[i],year_pos,cal_index,doy_ptr,doy_steps,base_start,base_end,percentile,half_window)
+    return out
+
+def _calendar_layout(times:np.ndarray, base_period:tuple[int,int] | None):
+    """
+    把时间坐标整理为 (年, 365日历日) 索引，2月29日不参与阈值样本、沿用2月28日阈值
+    返回: 年份、年序号、日历索引、按日历日分组的时间步（CSR）以及基准期年序号范围
     """
+    import pandas as pd
+    times = pd.DatetimeIndex(times)
+    years = np.asarray(times.year)
+    first = int(years.min())
+    year_pos = (years - first).astype(np.int64)
+    doy = np.asarray(times.dayofyear) - 1
+    leap = np.asarray(times.is_leap_year)
+    feb29 = leap & (doy == 59)
+    doy = np.where(leap & (doy >= 59), doy - 1, doy).astype(np.int64)
+    nyears = int(years.max()) - first + 1
+    cal_index = np.full((nyears, 365), -1, dtype=np.int64)
+    steps = np.arange(len(times))
+    cal_index[year_pos[~feb29], doy[~feb29]] = steps[~feb29]
+    doy_steps = np.argsort(doy, kind="stable").astype(np.int64)
+    doy_ptr = np.concatenate([[0], np.cumsum(np.bincount(doy, minlength=365))]).astype(np.int64)
+    if base_period is None:
+        base_start, base_end = 0, nyears - 1
+    else:
+        base_start = max(base_period[0] - first, 0)
+        base_end = min(base_period[1] - first, nyears - 1)
+        if base_start > base_end:
+            raise ValueError(f"Base period {base_period} does not overlap the data ({first}-{first + nyears - 1})")
+    return np.arange(first, first + nyears), year_pos, cal_index, doy_ptr, doy_steps, base_start, base_end
+
+def _etccdi_suite(da:xr.DataArray,time_dim:str,summer_threshold:float,winter_threshold:float,heatwave_threshold:float | None,min_duration:int,percentile:float | None,valid:xr.DataArray | None=None) -> xr.DataArray:
+    """一次读取得到全部 ETCCDI 指数 (..., index)，未计算的指数为 NaN"""
+    heatwave = np.nan if heatwave_threshold is None else float(heatwave_threshold)
+    # 标量参数按内核签名的类型传入，首次调用直接命中编译缓存
+    summer_threshold, winter_threshold, min_duration = float(summer_threshold), float(winter_threshold), int(min_duration)
+    if percentile is None:
+        # 不需要全序列百分位时按时间块顺序扫描，valid_time 可保持原生分块
+        state = scan_block(
+            _etccdi_scan,
+            da,
+            time_dim,
+            _ETCCDI_INIT,
+            args=(summer_threshold, winter_threshold, heatwave, min_duration),
+            valid=valid
+        )
+        stats = apply_block(
+            _etccdi_finish_block,
+            state,
+            "state",
+            args=(heatwave_threshold is not None,),
+            output_dim="index",
+            output_size=len(ETCCDI_INDICES),
+            valid=valid
+        )
+    else:
+        stats = apply_block(
+            _etccdi_block,
+            da,
+            time_dim,
+            args=(summer_threshold, winter_threshold, heatwave, min_duration, float(percentile)),
+            output_dim="index",
+            output_size=len(ETCCDI_INDICES),
+            valid=valid
+        )
+    return stats.assign_coords(index=list(ETCCDI_INDICES))
+
+def get_etccdi_stats(
+        nc_path:str,
+        var_name:str,
+        output_dir:str,
+        chunks :int | dict =512,
+        time_dim:str='valid_time',
+        summer_threshold:float=250,
+        winter_threshold:float=0,
+        heatwave_threshold:float | None=None,
+        min_duration:int=6,
+        percentile:float | None=None,
+        packed:bool=False,
+        shapefile:str="",
+        compress:str="LZW",
+        stack:bool=False
+    ) -> xr.DataArray:
+    """
+    单次读取数据，融合计算 TXx、TXn、ID、SU（可选 CHE、TXPD）
     参数:
-    nc_path : NetCDF文件路径
+    nc_path : NetCDF（.nc）或 Zarr（.zarr）路径
     var_name : 要分析的变量名
-    返回: 包含统计值的字典
+    output_dir : 输出目录
+    summer_threshold : 夏日阈值（默认250，即25℃）
+    winter_threshold : 冰日阈值（默认0）
+    heatwave_threshold : 高温事件阈值，为None时不计算CHE
+    min_duration : 高温事件最小持续天数（默认6）
+    percentile : 不为None时计算 TXPD：超过全序列该百分位的天数（不是 ETCCDI TX90p，后者见 tx90p_count）；
+                 计算TXPD时时间维需为单一分块
+    packed : 只把有效像元（非缺测且在区域内）聚成致密数组计算，跳过海洋和区域外像元
+    shapefile : 区域矢量文件，给出时区域外像元输出 NaN（隐含 packed）
+    compress : COG 压缩算法，"LZW"、"ZSTD" 或 "DEFLATE"
+    stack : 另把全部指数写入一个以指数名为波段描述的多波段 COG
+    返回: 以 index 维区分各指数的结果
     """
-    ds = xr.open_dataset(nc_path, chunks=chunks,engine='h5netcdf')
+    from .cog import write_cog, write_stack
+    from .store import open_store
+    ds = open_store(nc_path, chunks=chunks)
     if var_name not in ds.data_vars :
         raise ValueError(f"Variable '{var_name}' not found in dataset")
-    # valid_mask = ds[var_name].count(dim=time_dim) > 0
     path = Path(nc_path)
+    names = list(ETCCDI_INDICES[:4])
+    if heatwave_threshold is not None:
+        names.append("CHE")
+    if percentile is not None:
+        names.append("TXPD")
 
-
-    with ProgressBar():
-        # txx = ds[var_name].max(dim="valid_time").compute()
-        txx = xr.apply_ufunc(
-            _max,
-            ds[var_name],
-            input_core_dims=[[time_dim]],
-            vectorize=True,
-            dask='parallelized',
-            output_dtypes=[float]
-        ).compute()
-        txx.rio.to_raster(
-            os.path.join(output_dir, f"{path.name.split('.')[0]}-TXx.tif"),
-            dtype="float32",
-            compress="LZW"
-        )
-        del txx
-        # txn = ds[var_name].min(dim="valid_time").compute()
-        txn = xr.apply_ufunc(
-            _min,
-            ds[var_name],
-            input_core_dims=[[time_dim]],
-            vectorize=True,
-            dask='parallelized',
-            output_dtypes=[float]
-        ).compute()
-        txn.rio.to_raster(
-            os.path.join(output_dir, f"{path.name.split('.')[0]}-TXn.tif"),
-            dtype="float32",
-            compress="LZW"
-        )
-        del txn
-        # txn.rio.to_raster(os.path.join(output_dir, f"{path.name.split('.')[0]}-TXn.tif"))
-        # freeze_days = (ds[var_name] < 0).sum(dim="valid_time").where(valid_mask).compute()
-        freeze_days = xr.apply_ufunc(
-            _winterdays,
-            ds[var_name],
-            input_core_dims=[[time_dim]],
-            kwargs={"threshold": 0},
-            vectorize=True,
-            dask="parallelized",
-            output_dtypes=[float]
-        ).compute()
-        freeze_days.rio.to_raster(
-            os.path.join(output_dir, f"{path.name.split('.')[0]}-ID.tif"),
-            dtype="float32",
-            compress="LZW"
+    valid = valid_pixels(ds[var_name], time_dim, shapefile) if packed or shapefile else None
+    with stage("get_etccdi_stats", nc_path, indices=names):
+        # 一次 compute 同时得到全部指数，避免重复读取与解压
+        stats = _etccdi_suite(
+            ds[var_name], time_dim, summer_threshold, winter_threshold, heatwave_threshold, min_duration, percentile, valid
+        ).sel(index=names).compute()
+    for name in names:
+        write_cog(
+            stats.sel(index=name, drop=True),
+            os.path.join(output_dir, f"{path.name.split('.')[0]}-{name}.tif"),
+            compress
         )
-        del freeze_days
-        # freeze_days.rio.to_raster(os.path.join(output_dir, f"{path.name.split('.')[0]}-ID.tif"))
-        # summer_days = (ds[var_name] > 250).sum(dim="valid_time").where(valid_mask).compute()
-        summer_days = xr.apply_ufunc(
-            _summerdays,
-            ds[var_name],
-            input_core_dims=[[time_dim]],
-            kwargs={"threshold": 250},
-            vectorize=True,
-            dask="parallelized",
-            output_dtypes=[float]
-        ).compute()
-        # summer_days.rio.to_raster(os.path.join(output_dir, f"{path.name.split('.')[0]}-SU.tif"))
-        summer_days.rio.to_raster(
-            os.path.join(output_dir, f"{path.name.split('.')[0]}-SU.tif"),
-            dtype="float32",
-            compress="LZW"
+    if stack:
+        write_stack(
+            {name: stats.sel(index=name, drop=True) for name in names},
+            os.path.join(output_dir, f"{path.name.split('.')[0]}-ETCCDI.tif"),
+            compress
         )
-        del summer_days
     ds.close()
+    return stats
+
+
+def _year_segments(times:np.ndarray):
+    """
+    按自然年切分有序的时间坐标
+    返回: 各年份，以及各年在时间轴上的起点（末尾附序列长度）
+    """
+    import pandas as pd
+    years = np.asarray(pd.DatetimeIndex(times).year)
+    if np.any(np.diff(years) < 0):
+        raise ValueError("Time coordinate must be sorted to split it into calendar years")
+    starts = np.flatnonzero(np.r_[True, years[1:] != years[:-1]])
+    return years[starts], np.r_[starts, len(years)]
+
+def _year_chunks(offsets:np.ndarray,size:int | None) -> tuple[int, ...]:
+    """与年份边界对齐的时间分块：每年切为不超过 size 步的若干块，size 为None时每年一块"""
+    chunks = []
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        n = int(end - start)
+        step = n if size is None else size
+        chunks += [min(step, n - i) for i in range(0, n, step)]
+    return tuple(chunks)
+
+def annual_etccdi_cube(
+        nc_path:str | list[str],
+        var_name:str,
+        output_dir:str,
+        chunks:int | dict =512,
+        time_dim:str='valid_time',
+        summer_threshold:float=250,
+        winter_threshold:float=0,
+        heatwave_threshold:float | None=None,
+        min_duration:int=6,
+        percentile:float | None=None,
+        packed:bool=False,
+        shapefile:str="",
+        backend:str="netcdf",
+        out_var:str | None=None
+    ) -> xr.Dataset:
+    """
+    一次读取多年逐日数据，按自然年分段计算 TXx、TXn、ID、SU（可选 CHE、TXPD），
+    直接写出各指数的 (年, lat, lon) 立方体供 mannkendall 做趋势检验，
+    不再经逐年 TIFF、move_files 分拣、rename_file 改名与 tiffs_to_nc 重新堆叠。
+    时间分块先按年份边界对齐，各年在自己的时间块上扫描，全部年份在同一次 compute 中完成，每个分块只读取一次；
+    某年内有缺测时只有该年结果为 NaN，高温事件不跨年延续，与逐年文件分别计算的结果一致。
+    首尾不完整的年份按已有天数计算，各年天数保存在 days 坐标中
+    参数:
+    nc_path : 多年逐日 NetCDF（.nc）或 Zarr（.zarr）路径，或按时间拼接的多个年份文件
+    var_name : 要分析的变量名
+    output_dir : 输出目录，各指数写为 {指数}.nc（或 .zarr）
+    chunks : Dask分块策略，时间分块长度在各年内保持，跨年的分块在年份边界处切开
+    summer_threshold、winter_threshold、heatwave_threshold、min_duration、percentile、packed、shapefile : 同 get_etccdi_stats
+    backend : 输出格式，"netcdf" 或 "zarr"
+    out_var : 输出变量名，为None时与 var_name 相同，可直接作为 mannkendall 的 var_name
+    返回: 以指数为变量的 (time_dim, lat, lon) 数据集，时间坐标为各年1月1日
+    """
+    import pandas as pd
+    import xarray as xr
+    from .store import BACKENDS, open_store, write_store
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {list(BACKENDS)}")
+    paths = [nc_path] if isinstance(nc_path, str) else list(nc_path)
+    parts = [open_store(path, chunks=chunks) for path in paths]
+    try:
+        parts.sort(key=lambda part: part[time_dim].values[0])
+        ds = parts[0] if len(parts) == 1 else xr.concat(parts, dim=time_dim, data_vars="minimal", coords="minimal", compat="override")
+        if var_name not in ds.data_vars:
+            raise ValueError(f"Variable '{var_name}' not found in dataset")
+        da = ds[var_name]
+        years, offsets = _year_segments(da[time_dim].values)
+        if da.chunks is not None:
+            da = da.chunk({time_dim: _year_chunks(offsets, da.chunks[da.get_axis_num(time_dim)][0])})
+        names = list(ETCCDI_INDICES[:4])
+        if heatwave_threshold is not None:
+            names.append("CHE")
+        if percentile is not None:
+            names.append("TXPD")
+        valid = valid_pixels(da, time_dim, shapefile) if packed or shapefile else None
+        with stage("annual_etccdi_cube", paths[0] if len(paths) == 1 else os.path.commonpath(paths), years=len(years), indices=names):
+            annual = []
+            for start, end in zip(offsets[:-1], offsets[1:]):
+                segment = da.isel({time_dim: slice(int(start), int(end))})
+                if percentile is not None and segment.chunks is not None:
+                    # 百分位需要整年序列，各年的对齐分块在年内合并，不跨年读取
+                    segment = segment.chunk({time_dim: -1})
+                annual.append(_etccdi_suite(
+                    segment, time_dim, summer_threshold, winter_threshold, heatwave_threshold, min_duration, percentile, valid
+                ).sel(index=names))
+            stats = xr.concat(annual, dim=time_dim).compute()
+        stats = stats.assign_coords({
+            time_dim: pd.to_datetime([f"{year}-01-01" for year in years]),
+            "days": (time_dim, np.diff(offsets)),
+        })
+        cube = stats.transpose("index", time_dim, ...).astype(np.float32).to_dataset(dim="index")
+        if cube.rio.crs is None:
+            cube = cube.rio.write_crs("EPSG:4326")
+    finally:
+        for part in parts:
+            part.close()
 
+    os.makedirs(output_dir, exist_ok=True)
+    out_var = out_var or var_name
+    ny, nx = (cube.sizes[dim] for dim in cube[names[0]].dims[1:])
+    for name in names:
+        out = cube[[name]].rename({name: out_var})
+        out[out_var].attrs.update(standard_name=out_var, long_name=f"Annual {name} ({var_name})", units=ANNUAL_UNITS[name])
+        out.attrs["title"] = f"Annual ETCCDI index {name}"
+        out.attrs["history"] = f"Created on {pd.Timestamp.now():%Y-%m-%d} from {', '.join(os.path.basename(path) for path in paths)}"
+        encoding = {
+            out_var: {
+                'zlib': True,
+                'complevel': 4,
+                # 趋势检验按整段年份读取，时间方向为单一分块
+                'chunksizes': (len(years), min(512, ny), min(512, nx)),
+                'shuffle': True,
+                '_FillValue': np.nan,
+            },
+            time_dim: {'dtype': 'float64'}
+        }
+        write_store(out, os.path.join(output_dir, f"{name}{BACKENDS[backend]}"), encoding)
+    return cube
 
-def calculate_heatwave_events(nc_path: str, out_dir: str, temp_var: str = 'tm', threshold: float = 35.0, min_duration: int = 6, chunks: dict = {"valid_time": 100},time_dim:str="valid_time"):
+def calculate_heatwave_events(nc_path: str, out_dir: str, temp_var: str = 'tm', threshold: float = 35.0, min_duration: int = 6, chunks: dict = {"valid_time": 100},time_dim:str="valid_time",packed: bool = False,shapefile: str = "",compress: str = "LZW"):
     """
     计算连续高温事件（≥阈值温度且持续≥指定天数）
 
     参数：
-    nc_path      : 输入NetCDF文件路径
+    nc_path      : 输入 NetCDF（.nc）或 Zarr（.zarr）路径
     out_dir      : 输出目录
     temp_var     : 温度变量名（默认为'tm'）
     threshold    : 高温阈值（单位：℃，默认35）
     min_duration : 最小持续天数（默认6）
     chunks       : Dask分块策略（默认时间分块100）
+    packed       : 只计算有效像元（非缺测且在区域内）
+    shapefile    : 区域矢量文件，给出时区域外像元输出 NaN（隐含 packed）
+    compress     : COG 压缩算法，"LZW"、"ZSTD" 或 "DEFLATE"
     """
+    from .cog import write_cog
+    from .store import open_store
     path = Path(nc_path)
-    @jit(nopython=True)
-    def detect_events(arr,thresold,min_duration=6):
-        """
-        检测连续高温事件：返回事件次数
-        """
-        events = 0
-        current_length = 0
-        for val in arr:
-            if np.isnan(val):
-                return np.nan
-            if val > thresold:
-                current_length += 1
-                if current_length == min_duration:
-                    events += 1
-            else:
-                current_length = 0
-        return events
-    with xr.open_dataset(nc_path,chunks=chunks,engine="h5netcdf") as ds:
-        # ds = ds.chunk({'valid_time': -1})  # 合并valid_time为单一块
+    with open_store(nc_path,chunks=chunks) as ds:
         if temp_var not in ds.data_vars:
             raise ValueError(f"Variable '{temp_var}' not found in dataset")
-        with ProgressBar():
-            che = xr.apply_ufunc(detect_events,
-                ds[temp_var],
-                input_core_dims=[[time_dim]],
-                kwargs={"thresold":threshold,"min_duration":min_duration},
-                vectorize=True,
-                dask="parallelized",
-                output_dtypes=[float]).compute()
-        che.rio.to_raster(
-            os.path.join(out_dir, f"{path.name.split('.')[0]}-CHE.tif"),
-            dtype="float32",
-            compress="LZW"
-        )
+        valid = valid_pixels(ds[temp_var], time_dim, shapefile) if packed or shapefile else None
+        with stage("calculate_heatwave_events", nc_path):
+            # 按时间块顺序扫描，未结束的高温过程跨块延续，无需合并 valid_time
+            che = _heatwave_suite(ds[temp_var], threshold, min_duration, time_dim, valid).sel(metric="HWN", drop=True).compute()
+        write_cog(che, os.path.join(out_dir, f"{path.name.split('.')[0]}-CHE.tif"), compress)
         del che
         ds.close()
 
-def tx90p_count(nc_path: str, out_dir: str, temp_var: str = 'tm', threshold: float = 35.0, chunks: dict = {"valid_time": 100},time_dim:str="valid_time"):
+def heatwave_metrics(
+        nc_path: str,
+        out_dir: str,
+        temp_var: str = 'tm',
+        threshold: float | xr.DataArray = 35.0,
+        min_duration: int = 6,
+        chunks: dict = {"valid_time": 100},
+        time_dim: str = "valid_time",
+        percentile: float | None = None,
+        packed: bool = False,
+        shapefile: str = "",
+        compress: str = "LZW"
+    ) -> xr.DataArray:
+    """
+    一次游程扫描计算高温过程指标，输出多波段 GeoTIFF
+    HWN：高温过程次数；HWF：高温过程总天数；HWD：最长过程天数；
+    HWM：各过程平均温度的均值；HWA：高温过程中的最高温度
+
+    参数：
+    nc_path      : 输入 NetCDF（.nc）或 Zarr（.zarr）路径
+    out_dir      : 输出目录
+    temp_var     : 温度变量名（默认为'tm'）
+    threshold    : 高温阈值，常数或逐像元阈值 (lat, lon)
+    min_duration : 最小持续天数（默认6）
+    chunks       : Dask分块策略（默认时间分块100）
+    percentile   : 不为None时以逐像元百分位（0~100）作为阈值，忽略 threshold
+    packed       : 只计算有效像元（非缺测且在区域内）
+    shapefile    : 区域矢量文件，给出时区域外像元输出 NaN（隐含 packed）
+    compress     : COG 压缩算法，"LZW"、"ZSTD" 或 "DEFLATE"
+    返回: (metric, lat, lon) 指标
+    """
+    from .cog import write_stack
+    from .quantile import histogram_quantile
+    from .store import open_store
+    path = Path(nc_path)
+    if percentile is not None:
+        with open_store(nc_path) as raw:
+            threshold = histogram_quantile(raw[temp_var], percentile / 100, dim=time_dim)
+    with open_store(nc_path,chunks=chunks) as ds:
+        if temp_var not in ds.data_vars:
+            raise ValueError(f"Variable '{temp_var}' not found in dataset")
+        valid = valid_pixels(ds[temp_var], time_dim, shapefile) if packed or shapefile else None
+        with stage("heatwave_metrics", nc_path):
+            metrics = _heatwave_suite(ds[temp_var], threshold, min_duration, time_dim, valid).transpose("metric", ...).compute()
+        write_stack(
+            metrics.to_dataset(dim="metric"),
+            os.path.join(out_dir, f"{path.name.split('.')[0]}-HW.tif"),
+            compress
+        )
+    return metrics
+
+def tx90p_count(
+        nc_path: str,
+        out_dir: str,
+        temp_var: str = 'tm',
+        *,
+        percentile: float = 90,
+        chunks: dict = {"valid_time": 100},
+        time_dim:str="valid_time",
+        base_period: tuple[int, int] | None = None,
+        window: int = 5,
+        packed: bool = False,
+        shapefile: str = "",
+        compress: str = "LZW",
+        threshold: float | None = None
+    ) -> xr.DataArray:
     """
-    计算90%高温事件的个数
+    计算 ETCCDI TX90p：日最高温超过日历日百分位阈值的天数百分比
+    阈值取基准期内以该日为中心的 window 日滑动窗口样本的百分位（与 climdex 相同，采用第8类百分位估计），
+    基准期内年份采用 bootstrap 方法消除不连续性。
+    旧版本的 threshold 参数（默认35）是全序列百分位，结果为超过全序列该百分位的天数，即现在 get_etccdi_stats 的 TXPD；
+    为避免旧调用静默得到另一种量，threshold 已移除，传入时报错，temp_var 之后的参数只能按关键字传入
     参数：
-        nc_path      : NetCDF文件路径
+        nc_path      : NetCDF（.nc）或 Zarr（.zarr）路径
         out_dir      : 输出目录
         temp_var     : 温度变量名（默认'tm'）
-        threshold    : 高温阈值（默认35.0）
-        min_duration : 最小持续时间（默认6）
-        chunks       : Dask分块策略（默认时间分块100）
+        percentile   : 阈值百分位（0~100，默认90）
+        chunks       : Dask分块策略，时间维需为单一分块
+        base_period  : 基准期起止年份，为None时以全部年份为基准期
+        window       : 滑动窗口天数（默认5）
+        packed       : 只计算有效像元（非缺测且在区域内）
+        shapefile    : 区域矢量文件，给出时区域外像元输出 NaN（隐含 packed）
+        compress     : COG 压缩算法，"LZW"、"ZSTD" 或 "DEFLATE"
+        threshold    : 已移除，传入时报错
+    返回: (year, ...) 各年 TX90p
     """
+    if threshold is not None:
+        raise TypeError(
+            "tx90p_count no longer takes 'threshold' (the old whole-series percentile count): "
+            "use get_etccdi_stats(..., percentile=...) for that count (TXPD), "
+            "or tx90p_count(..., percentile=...) for the ETCCDI TX90p"
+        )
+    if not 0 < percentile < 100:
+        raise ValueError(f"percentile must be in (0, 100), got {percentile}")
+    from .cog import write_cog
+    from .store import open_store
     path = Path(nc_path)
-    with xr.open_dataset(nc_path,chunks=chunks,engine="h5netcdf") as ds:
+    with open_store(nc_path,chunks=chunks) as ds:
         if temp_var not in ds.data_vars:
             raise ValueError(f"Variable '{temp_var}' not found in dataset")
-        with ProgressBar():
-            tx90p = xr.apply_ufunc(
-                _precentile,
+        years, year_pos, cal_index, doy_ptr, doy_steps, base_start, base_end = _calendar_layout(ds[time_dim].values, base_period)
+        valid = valid_pixels(ds[temp_var], time_dim, shapefile) if packed or shapefile else None
+        with stage("tx90p_count", nc_path):
+            tx90p = apply_block(
+                _tx90p_block,
                 ds[temp_var],
-                input_core_dims=[[time_dim]],
-                kwargs={"percentile":threshold},
-                vectorize=True,
-                dask="parallelized",
-                output_dtypes=[float]
-            ).compute()
-        tx90p.rio.to_raster(
-            os.path.join(out_dir, f"{path.name.split('.')[0]}-TX90P.tif"),
-            dtype="float32",
-            compress="LZW"
-        )
-        del tx90p
-    ds.close()
+                time_dim,
+                args=(year_pos, cal_index, doy_ptr, doy_steps, int(base_start), int(base_end), float(percentile), int(window // 2)),
+                output_dim="year",
+                output_size=len(years),
+                valid=valid
+            ).assign_coords(year=years).transpose("year", ...).compute()
+        stem = path.name.split('.')[0]
+        for year in years:
+            name = f"{stem}-TX90P.tif" if len(years) == 1 else f"{stem}-{year}-TX90P.tif"
+            write_cog(tx90p.sel(year=year, drop=True), os.path.join(out_dir, name), compress)
+    return tx90p
@@ -0,0 +1,57 @@
+import argparse
+import sys
+
+
+def main(argv: list[str] | None = None) -> int:
+    """lun-wen 命令行入口，只在执行对应子命令时才导入计算模块"""
+    parser = argparse.ArgumentParser(prog="lun-wen", description="按配置文件增量运行论文数据处理流水线")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="运行流水线，只重算输入或参数变化的任务")
+    run.add_argument("targets", nargs="*", help="只运行这些阶段及其上游，默认全部")
+    run.add_argument("-c", "--config", default="pipeline.toml", help="流水线配置 TOML")
+    run.add_argument("-j", "--works", type=int, default=None, help="同时运行的阶段数")
+    run.add_argument("-f", "--force", action="store_true", help="忽略指纹全部重算")
+    run.add_argument("-n", "--dry-run", action="store_true", help="只列出需要运行的任务")
+    run.add_argument("--trace", default=None, help="阶段耗时、I/O 与内存记录，逐行追加到 .jsonl 或 .csv")
+
+    commands.add_parser("stages", help="按依赖顺序列出配置中的阶段").add_argument(
+        "-c", "--config", default="pipeline.toml", help="流水线配置 TOML"
+    )
+    commands.add_parser("precompile", help="预先编译并缓存全部 numba 块内核")
+
+    args = parser.parse_args(argv)
+    if args.command == "precompile":
+        from ._blocks import precompile
+        print(f"已编译 {precompile()} 个内核签名")
+        return 0
+
+    from .runner import load_config, run_pipeline
+    config = load_config(args.config)
+    if args.command == "stages":
+        for name in config["order"]:
+            spec = config["stages"][name]
+            needs = ", ".join(spec.get("needs", [])) or "-"
+            print(f"{name:<16} {spec['action']:<12} 依赖: {needs}")
+        return 0
+
+    results = run_pipeline(
+        config,
+        args.targets or None,
+        works=args.works,
+        force=args.force,
+        dry_run=args.dry_run,
+        trace=args.trace
+    )
+    for name, result in results.items():
+        if result["status"] == "done" and args.dry_run:
+            print(f"{name:<16} {result['stale']}/{result['jobs']} 个任务需要运行")
+        elif result["status"] == "done":
+            print(f"{name:<16} 完成  {result['ran']}/{result['jobs']} 个任务已运行")
+        else:
+            print(f"{name:<16} {'失败' if result['status'] == 'failed' else '跳过'}  {result.get('error', '')}")
+    return 0 if all(result["status"] == "done" for result in results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
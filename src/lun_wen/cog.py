@@ -0,0 +1,72 @@
+import numpy as np
+import rioxarray  # 注册 .rio 访问器
+import xarray as xr
+from .instrument import stage
+
+COMPRESSIONS = ("LZW", "ZSTD", "DEFLATE")
+BLOCKSIZE = 512
+
+
+def write_cog(
+        da: xr.DataArray,
+        path: str,
+        compress: str = "LZW",
+        descriptions: list[str] | None = None,
+        dtype: str = "float32",
+        blocksize: int = BLOCKSIZE,
+        threads: int | str = "ALL_CPUS"
+    ) -> None:
+    """
+    写出云优化 GeoTIFF（COG）：内部 512×512 分块、自动生成平均值重采样的金字塔，
+    浮点数据使用浮点预测器（PREDICTOR=3），压缩由 GDAL 多线程进行
+    参数：
+        da           : (y, x) 单波段或 (band, y, x) 多波段数据，需已写入 CRS
+        path         : 输出路径
+        compress     : 压缩算法，"LZW"、"ZSTD" 或 "DEFLATE"
+        descriptions : 各波段描述，为None时沿用 long_name 属性
+        dtype        : 输出数据类型
+        blocksize    : 分块边长
+        threads      : 压缩线程数，"ALL_CPUS" 为全部核心
+    """
+    compress = compress.upper()
+    if compress not in COMPRESSIONS:
+        raise ValueError(f"不支持的压缩算法：{compress}，可选 {list(COMPRESSIONS)}")
+    da = da.astype(dtype)
+    if descriptions is not None:
+        da.attrs["long_name"] = tuple(descriptions)
+    floating = np.issubdtype(np.dtype(dtype), np.floating)
+    if floating and da.rio.nodata is None and da.rio.encoded_nodata is None:
+        da = da.rio.write_nodata(np.nan)
+    with stage("write_cog", path, kind="io", bands=da.sizes.get("band", 1)):
+        da.rio.to_raster(
+            path,
+            driver="COG",
+            dtype=dtype,
+            COMPRESS=compress,
+            PREDICTOR=3 if floating else 2,
+            BLOCKSIZE=blocksize,
+            OVERVIEWS="AUTO",
+            RESAMPLING="AVERAGE",
+            NUM_THREADS=threads
+        )
+
+
+def write_stack(
+        layers: dict[str, xr.DataArray] | xr.Dataset,
+        path: str,
+        compress: str = "LZW",
+        **kwargs
+    ) -> None:
+    """
+    把多个同网格的 (y, x) 结果合成一个多波段 COG，波段描述为各结果名称，
+    GIS 中打开一个文件即可查看同一年的全部指数
+    参数：
+        layers   : {名称: (y, x) 数据} 或数据集
+        path     : 输出路径
+        compress : 压缩算法
+        kwargs   : 传给 write_cog 的其他参数
+    """
+    names = list(layers.data_vars if isinstance(layers, xr.Dataset) else layers)
+    stack = xr.concat([layers[name] for name in names], dim="band", coords="minimal", compat="override")
+    stack = stack.assign_coords(band=np.arange(1, len(names) + 1))
+    write_cog(stack, path, compress, descriptions=names, **kwargs)
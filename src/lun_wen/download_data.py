@@ -1,4 +1,15 @@
+import json
+import os
+import random
+import shutil
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable
 import cdsapi
+import xarray as xr
+from .instrument import stage
 
 def download_data(year:int):
     dataset = "derived-era5-single-levels-daily-statistics"
@@ -35,9 +46,13 @@ def download_data(year:int):
     output_file =f"{year}.nc"
     client.retrieve(dataset, request,output_file)
 
-def download_era5_data(year:int,month:int):
-    dataset = "derived-era5-land-daily-statistics"
-    request = {
+ERA5_LAND_DATASET = "derived-era5-land-daily-statistics"
+MANIFEST = "manifest.json"
+
+
+def era5_land_request(year:int,month:int,area:list=[54, 73, 3, 136]) -> dict:
+    """ERA5-Land 逐日最高气温的单月请求"""
+    return {
         "variable": ["2m_temperature"],
         "year": str(year),
         "month": str(month).zfill(2),
@@ -57,10 +72,168 @@ def download_era5_data(year:int,month:int):
         "daily_statistic": "daily_maximum",
         "time_zone": "utc+08:00",
         "frequency": "1_hourly",
-        "area": [54, 73, 3, 136]
+        "area": area
     }
+
+def download_era5_data(year:int,month:int):
     client = cdsapi.Client()
     try:
-        client.retrieve(dataset, request, f"{year}_{month}.nc")
+        client.retrieve(ERA5_LAND_DATASET, era5_land_request(year, month), f"{year}_{month}.nc")
     except Exception:
-        client.retrieve(dataset, request, f"{year}_{month}.nc")
+        client.retrieve(ERA5_LAND_DATASET, era5_land_request(year, month), f"{year}_{month}.nc")
+
+
+class _Manifest:
+    """记录每个月份下载状态的 JSON 清单，多线程共享，每次更新后原子写回"""
+
+    def __init__(self, path:str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def get(self, key:str) -> dict:
+        with self.lock:
+            return dict(self.entries.get(key, {}))
+
+    def update(self, key:str, **values) -> None:
+        with self.lock:
+            self.entries.setdefault(key, {}).update(values)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f, indent=2, ensure_ascii=False)
+            os.replace(tmp, self.path)
+
+
+def _resume(location:str, part:str) -> bool:
+    """
+    按 HTTP Range 从 .part 已有长度处续传，服务器不支持续传时从头下载
+    返回: 是否成功
+    """
+    if not location.startswith(("http://", "https://")):
+        return False
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    request = urllib.request.Request(location, headers={"Range": f"bytes={offset}-"} if offset else {})
+    try:
+        with urllib.request.urlopen(request, timeout=600) as response:
+            mode = "ab" if offset and response.status == 206 else "wb"
+            with open(part, mode) as f:
+                shutil.copyfileobj(response, f, 1 << 20)
+    except urllib.error.HTTPError as error:
+        # 416：.part 已完整
+        return error.code == 416
+    except OSError:
+        return False
+    return True
+
+
+def _verify(path:str, expected:int | None) -> None:
+    """校验文件大小与 NetCDF 可读性：未下载完整时抛出 IOError（可续传），文件损坏时抛出 ValueError"""
+    size = os.path.getsize(path)
+    if expected and size < expected:
+        raise IOError(f"{path} 只下载了 {size}/{expected} 字节")
+    if expected and size != expected:
+        raise ValueError(f"{path} 大小为 {size}，应为 {expected}")
+    try:
+        with xr.open_dataset(path, engine="h5netcdf") as ds:
+            empty = not ds.data_vars
+    except Exception as error:
+        raise ValueError(f"{path} 无法作为 NetCDF 读取：{error}") from error
+    if empty:
+        raise ValueError(f"{path} 中没有数据变量")
+
+
+def _attempt_month(client_factory:Callable, manifest:_Manifest, key:str, year:int, month:int, output:str, part:str) -> str:
+    """单次下载尝试：续传或重新提交请求，校验后改名为正式文件"""
+    entry = manifest.get(key)
+    # 已有下载地址时先对同一结果续传，地址失效再重新提交请求
+    if not (entry.get("location") and os.path.exists(part) and _resume(entry["location"], part)):
+        result = client_factory().retrieve(ERA5_LAND_DATASET, era5_land_request(year, month))
+        location = getattr(result, "location", None)
+        manifest.update(key, status="downloading", location=location, size=getattr(result, "content_length", None))
+        if not (location and _resume(location, part)):
+            result.download(part)
+    _verify(part, manifest.get(key).get("size"))
+    os.replace(part, output)
+    manifest.update(key, status="done", path=output, size=os.path.getsize(output), error=None)
+    return output
+
+
+def _download_month(client_factory:Callable, manifest:_Manifest, year:int, month:int, output:str, retries:int, backoff:float, stop:threading.Event) -> str:
+    key = f"{year}-{month:02d}"
+    part = f"{output}.part"
+    for attempt in range(retries + 1):
+        if stop.is_set():
+            raise RuntimeError(f"{year}年{month}月的下载已取消")
+        try:
+            with stage("download_month", output, kind="io", attempt=attempt):
+                return _attempt_month(client_factory, manifest, key, year, month, output, part)
+        except Exception as error:
+            if isinstance(error, ValueError) and os.path.exists(part):
+                # 校验不通过的文件无法续传，丢弃后重新提交请求
+                os.remove(part)
+                manifest.update(key, location=None)
+            manifest.update(key, status="failed", error=str(error), attempts=attempt + 1)
+            # 退避期间取消时不再重试，按本次的异常返回
+            if attempt == retries or stop.wait(backoff * 2 ** attempt + random.uniform(0, backoff)):
+                raise
+
+
+def download_months(
+        months:list[tuple[int, int]],
+        out_dir:str = "data",
+        works:int = 4,
+        retries:int = 5,
+        backoff:float = 30,
+        client_factory:Callable = cdsapi.Client,
+        callback:Callable | None = None,
+        stop:threading.Event | None = None
+    ) -> dict:
+    """
+    并发、可续传地批量下载 ERA5-Land 逐月数据，文件名为 {year}_{month}.nc
+    清单 manifest.json 记录每个月份的状态、下载地址与文件大小，已完成且校验通过的月份直接跳过；
+    中断留下的 .part 文件在下次运行时按 HTTP Range 续传
+    参数：
+        months         : [(year, month), ...]
+        out_dir        : 输出目录
+        works          : 同时进行的请求数
+        retries        : 失败后的重试次数，间隔按 backoff*2^n 加随机抖动指数退避
+        backoff        : 退避基准秒数
+        client_factory : 返回 CDS 客户端的可调用对象，测试时可替换为本地替身，
+                         客户端需提供 retrieve(dataset, request) 并返回带 download(target) 的结果
+        callback       : 每个月份就绪（下载完成或已存在）时以 (year, month, 文件路径) 调用，供下游流水线消费
+        stop           : 取消事件，置位后不再提交新的请求、退避等待立即结束，未完成的月份返回异常
+    返回: {(year, month): 文件路径或异常}
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = _Manifest(os.path.join(out_dir, MANIFEST))
+    stop = stop or threading.Event()
+    results = {}
+    todo = []
+    for year, month in months:
+        output = os.path.join(out_dir, f"{year}_{month}.nc")
+        entry = manifest.get(f"{year}-{month:02d}")
+        if entry.get("status") == "done" and os.path.exists(output) and os.path.getsize(output) == entry.get("size"):
+            results[(year, month)] = output
+            if callback is not None:
+                callback(year, month, output)
+        else:
+            todo.append((year, month, output))
+    with ThreadPoolExecutor(max_workers=works) as pool:
+        futures = {
+            pool.submit(_download_month, client_factory, manifest, year, month, output, retries, backoff, stop): (year, month)
+            for year, month, output in todo
+        }
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+                print(f"{futures[future][0]}年{futures[future][1]}月下载完成")
+            except Exception as error:
+                results[futures[future]] = error
+                print(f"{futures[future][0]}年{futures[future][1]}月下载失败：{error}")
+                continue
+            if callback is not None:
+                callback(*futures[future], results[futures[future]])
+    return results
@@ -0,0 +1,216 @@
+import os
+import queue
+import threading
+from datetime import datetime
+import dask.array as dask_array
+import h5py
+import numpy as np
+import pandas as pd
+import xarray as xr
+from .download_data import download_months
+from .instrument import stage
+from .mask import grid_mask, mask_window
+from .store import BACKENDS, is_zarr, preallocate
+
+# 队列结束标记
+_DONE = object()
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> None:
+    """阻塞放入有界队列，下游出错停止时放弃"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=1)
+            return
+        except queue.Full:
+            continue
+
+
+def _get(q: queue.Queue, stop: threading.Event):
+    """从队列取出一项，下游出错停止时返回结束标记"""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=1)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def convert_month(path: str, shapefile: str = "") -> tuple[np.ndarray, xr.Dataset]:
+    """
+    把单月 ERA5-Land 文件换算为 0.1°C 并按区域掩膜裁剪，与 nc_to_tiff 的换算和裁剪一致
+    参数：
+        path      : 单月 NetCDF 文件
+        shapefile : 掩膜矢量文件路径，为空时不裁剪
+    返回: ((time, lat, lon) float32 数组, 只含坐标的数据集)
+    """
+    with stage("convert_month", path), xr.open_dataset(path, engine="h5netcdf") as ds:
+        ds = ds.rio.write_crs("EPSG:4326")
+        da = ds[list(ds.data_vars)[0]].transpose("valid_time", "latitude", "longitude")
+        mask = None
+        if shapefile != "":
+            mask = grid_mask(da.isel(valid_time=0, drop=True), shapefile)
+            ys, xs = mask_window(mask)
+            mask = mask[ys, xs]
+            da = da.isel(latitude=ys, longitude=xs)
+        block = np.round((da.values - 273.15) * 10).astype(np.float32)
+        if mask is not None:
+            block[:, ~mask] = np.nan
+        coords = da.coords.to_dataset().load()
+    return block, coords
+
+
+def _year_store(
+        coords: xr.Dataset,
+        year: int,
+        path: str,
+        var: str,
+        chunks: int
+    ) -> None:
+    """按第一个到达的月份的网格为一整年预分配 (valid_time, latitude, longitude) 存储"""
+    times = pd.date_range(f"{year}-01-01", f"{year}-12-31", freq="D")
+    lat = coords["latitude"].values
+    lon = coords["longitude"].values
+    chunk_shape = (1, min(chunks, len(lat)), min(chunks, len(lon)))
+    ds = xr.Dataset(
+        {var: (("valid_time", "latitude", "longitude"), dask_array.empty((len(times), len(lat), len(lon)), dtype=np.float32, chunks=chunk_shape))},
+        coords={"valid_time": times, "latitude": lat, "longitude": lon}
+    ).rio.write_crs("EPSG:4326")
+    ds[var].attrs['standard_name'] = var
+    ds[var].attrs['long_name'] = f"Daily Maximum Temperature ({var})"
+    ds[var].attrs['units'] = "0.1°C"
+    ds.attrs['title'] = "Daily Maximum Temperature Data"
+    ds.attrs['source'] = "ERA5-Land derived daily statistics"
+    ds.attrs['history'] = f"Created on {datetime.now().strftime('%Y-%m-%d')}"
+    encoding = {
+        var: {
+            'zlib': True,
+            'complevel': 4,
+            'chunksizes': chunk_shape,
+            'shuffle': True,
+            '_FillValue': np.nan,
+        },
+        'valid_time': {'dtype': 'float64'}
+    }
+    preallocate(ds, path, encoding)
+
+
+def ingest(
+        years: list[int],
+        out_dir: str = "ncs/ingest",
+        shapefile: str = "",
+        var: str = "t2m",
+        download_dir: str = "data",
+        backend: str = "netcdf",
+        works: int = 4,
+        converters: int = 2,
+        queue_size: int = 2,
+        chunks: int = 512,
+        **download_kwargs
+    ) -> dict:
+    """
+    流水线式入库：下载、换算裁剪、写入三个阶段并行，某月文件一下载完成就换算为 0.1°C、
+    裁剪后写入对应年份的分析存储，同时后续月份仍在下载，总耗时接近最慢阶段而非各阶段之和。
+    阶段之间为有界队列，下游慢时上游阻塞，在途的换算结果最多 queue_size 个月。
+    年份存储按整年逐日预分配，缺失的月份保持缺测；写入只在主线程进行。
+    参数：
+        years           : 年份列表
+        out_dir         : 年份存储输出目录，文件名为 {year}.nc 或 {year}.zarr
+        shapefile       : 掩膜矢量文件路径，为空时不裁剪
+        var             : 输出变量名
+        download_dir    : 逐月原始文件与下载清单目录
+        backend         : 存储格式，"netcdf" 或 "zarr"
+        works           : 同时下载的请求数
+        converters      : 换算线程数
+        queue_size      : 阶段间队列长度
+        chunks          : 空间块大小，时间方向每块1步
+        download_kwargs : 传给 download_months 的其他参数（retries、backoff、client_factory）
+    返回: {(year, month): 年份存储路径或异常}
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"不支持的存储格式：{backend}，可选 {list(BACKENDS)}")
+    os.makedirs(out_dir, exist_ok=True)
+    months = [(year, month) for year in years for month in range(1, 13)]
+    downloaded = queue.Queue(maxsize=queue_size)
+    converted = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    download_results = {}
+
+    def _download() -> None:
+        try:
+            download_results.update(download_months(
+                months,
+                out_dir=download_dir,
+                works=works,
+                callback=lambda year, month, path: _put(downloaded, (year, month, path), stop),
+                stop=stop,
+                **download_kwargs
+            ))
+        finally:
+            for _ in range(converters):
+                _put(downloaded, _DONE, stop)
+
+    def _convert() -> None:
+        while True:
+            item = _get(downloaded, stop)
+            if item is _DONE:
+                break
+            year, month, path = item
+            try:
+                _put(converted, (year, month, *convert_month(path, shapefile)), stop)
+            except Exception as error:
+                _put(converted, (year, month, error, None), stop)
+        _put(converted, _DONE, stop)
+
+    threads = [threading.Thread(target=_download, daemon=True)]
+    threads += [threading.Thread(target=_convert, daemon=True) for _ in range(converters)]
+    for thread in threads:
+        thread.start()
+
+    results = {}
+    stores = {}
+    finished = 0
+    try:
+        while finished < converters:
+            item = converted.get()
+            if item is _DONE:
+                finished += 1
+                continue
+            year, month, block, coords = item
+            if isinstance(block, Exception):
+                results[(year, month)] = block
+                print(f"{year}年{month}月换算失败：{block}")
+                continue
+            path = os.path.join(out_dir, f"{year}{BACKENDS[backend]}")
+            if year not in stores:
+                _year_store(coords, year, path, var, chunks)
+                if is_zarr(path):
+                    import zarr
+                    stores[year] = zarr.open_group(path, mode="r+")[var]
+                else:
+                    stores[year] = h5py.File(path, "r+")[var]
+            target = stores[year]
+            if target.shape[1:] != block.shape[1:]:
+                results[(year, month)] = ValueError(f"{year}年{month}月的网格 {block.shape[1:]} 与年份存储 {target.shape[1:]} 不一致")
+                continue
+            days = (pd.DatetimeIndex(coords["valid_time"].values).normalize() - pd.Timestamp(f"{year}-01-01")).days
+            start = int(days[0])
+            with stage("write_month", path, kind="io", month=month):
+                target[start:start + len(block)] = block
+            results[(year, month)] = path
+            print(f"{year}年{month}月已写入 {path}")
+    finally:
+        # 写入出错时先置位 stop，下载线程不再提交新请求、退避立即结束，只等在途的请求完成
+        stop.set()
+        for thread in threads:
+            thread.join()
+        for year, target in stores.items():
+            if isinstance(target, h5py.Dataset):
+                target.file.close()
+            else:
+                import zarr
+                zarr.consolidate_metadata(os.path.join(out_dir, f"{year}{BACKENDS[backend]}"))
+    for key, value in download_results.items():
+        if isinstance(value, Exception):
+            results[key] = value
+    return results
@@ -0,0 +1,251 @@
+import contextlib
+import csv
+import json
+import os
+import resource
+import threading
+import time
+from collections import defaultdict
+
+# fresh：path 尚未写入本次运行的记录，写入首条记录时清空旧内容
+_config = {"path": None, "progress": True, "task_stream": False, "fresh": False}
+_records = []
+_lock = threading.Lock()
+_local = threading.local()
+# 进行中的阶段，块内核在 dask 工作线程中执行，耗时计入全部进行中的阶段
+_active = []
+# 逐行追加的 CSV 记录的列，其余标量字段以 JSON 写入 fields 列
+CSV_COLUMNS = (
+    "stage", "file", "kind", "thread", "concurrent", "start", "wall_seconds",
+    "read_bytes", "write_bytes", "rchar", "wchar", "peak_rss", "tasks", "graph_tasks",
+    "io_seconds", "kernel_seconds", "error", "fields"
+)
+
+
+def configure(path: str | None = None, progress: bool = True, task_stream: bool = False) -> None:
+    """
+    设置全局记录方式并清空内存中的记录（见 records），此后每个阶段结束时把该阶段的记录追加到 path 末尾；
+    path 中已有的内容在写入首条记录时才清空，没有阶段运行时（如全部任务跳过）保留上次的记录
+    参数：
+        path        : 记录文件，.csv 逐行追加，其他扩展名（如 .jsonl）每行一个 JSON 对象；
+                      为None时只保留在内存中（见 records、write_trace）
+        progress    : 最外层阶段中有 dask 计算时是否在终端显示进度条
+        task_stream : 是否在 JSON 记录中保存每个任务的线程与起止时间
+    """
+    with _lock:
+        _config.update(path=path, progress=progress, task_stream=task_stream, fresh=True)
+        _records.clear()
+
+
+def records() -> list[dict]:
+    """已完成阶段的记录"""
+    with _lock:
+        return list(_records)
+
+
+def reset() -> None:
+    with _lock:
+        _records.clear()
+
+
+def _proc_io() -> dict:
+    """/proc/self/io：read_bytes、write_bytes 为实际落到块设备的字节，rchar、wchar 含页缓存命中"""
+    try:
+        with open("/proc/self/io") as f:
+            return {key: int(value) for key, value in (line.split(": ") for line in f)}
+    except OSError:
+        return {}
+
+
+def _peak_rss() -> int:
+    """进程峰值常驻内存（字节），优先读 VmHWM，其可按阶段重置"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak() -> None:
+    """把 VmHWM 重置为当前常驻内存（Linux 4.0+），失败时峰值按进程生命周期计"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class _TaskTimer:
+    """dask 回调：统计任务数，按任务名前缀累计耗时，可选保存任务流；dask 在进入阶段时才导入，见 callback"""
+
+    def __init__(self, task_stream: bool = False):
+        from dask.utils import key_split
+        self.key_split = key_split
+        self.task_stream = task_stream
+        self.tasks = 0
+        self.graph_tasks = 0
+        self.seconds = defaultdict(float)
+        self.stream = []
+        self._started = {}
+
+    def _start(self, dsk):
+        self.graph_tasks += len(dsk)
+
+    def _pretask(self, key, dsk, state):
+        self._started[key] = time.perf_counter()
+
+    def _posttask(self, key, result, dsk, state, worker_id):
+        end = time.perf_counter()
+        start = self._started.pop(key, end)
+        self.tasks += 1
+        self.seconds[self.key_split(key)] += end - start
+        if self.task_stream:
+            self.stream.append({"key": str(key), "worker": worker_id, "start": start, "end": end})
+
+    def callback(self):
+        from dask.callbacks import Callback
+        return Callback(start=self._start, pretask=self._pretask, posttask=self._posttask)
+
+
+@contextlib.contextmanager
+def kernel():
+    """包住数值内核调用，耗时计入进行中阶段的 kernel_seconds"""
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - begin
+        with _lock:
+            for record in _active:
+                record["_kernel"] = record.get("_kernel", 0.0) + elapsed
+
+
+def _append(path: str, record: dict, fresh: bool = False) -> None:
+    """把一条记录追加到 path，写入量与记录条数无关；fresh 时先清空文件，CSV 文件新建或清空时写表头"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if fresh:
+        open(path, "w").close()
+    if path.endswith(".csv"):
+        scalars = {k: v for k, v in record.items() if not isinstance(v, (dict, list))}
+        row = {k: v for k, v in scalars.items() if k in CSV_COLUMNS}
+        extra = {k: v for k, v in scalars.items() if k not in CSV_COLUMNS}
+        row["fields"] = json.dumps(extra, ensure_ascii=False) if extra else ""
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        with open(path, "a", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, CSV_COLUMNS)
+            if new:
+                writer.writeheader()
+            writer.writerow(row)
+    else:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def _write(path: str, rows: list[dict]) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.tmp"
+    if path.endswith(".csv"):
+        # CSV 只保存标量字段
+        columns = list(dict.fromkeys(k for row in rows for k, v in row.items() if not isinstance(v, (dict, list))))
+        with open(tmp, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, columns, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+@contextlib.contextmanager
+def stage(name: str, file: str | None = None, kind: str = "compute", **fields):
+    """
+    记录一个阶段的墙钟时间、读写字节数、峰值内存与 dask 任务数，
+    并把 dask 任务耗时分为计算内核（kernel_seconds，见 kernel）与读取、解码等其余部分（io_seconds），替代 ProgressBar
+    阶段可以嵌套，内层阶段的峰值内存计入外层。
+    峰值内存与 dask 回调都是整个进程共享的：其他线程的阶段与本阶段有重叠时记录 concurrent=True，
+    此时 peak_rss、tasks、graph_tasks、task_seconds、io_seconds、kernel_seconds 与读写字节数为
+    重叠期间整个进程的值，不能只归于本阶段；没有重叠时才重置峰值内存
+    参数：
+        name   : 阶段名，如 "get_etccdi_stats"、"write_cog"
+        file   : 该阶段处理的输入或输出文件
+        kind   : 阶段类别，"compute"、"io" 等，无 dask 任务的纯 I/O 阶段全部计为 io_seconds
+        fields : 附加到记录中的其他字段
+    返回: 记录字典，阶段结束后填充
+    """
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    thread = threading.get_ident()
+    record = {"stage": name, "file": file, "kind": kind, "thread": thread, "concurrent": False, **fields}
+    timer = _TaskTimer(_config["task_stream"])
+    io_before = _proc_io()
+    if stack:
+        # 重置前先把外层阶段到目前为止的峰值记下
+        stack[-1]["_child_peak"] = max(stack[-1].get("_child_peak", 0), _peak_rss())
+    stack.append(record)
+    with _lock:
+        others = [active for active in _active if active["thread"] != thread]
+        for active in others:
+            active["concurrent"] = True
+        if others:
+            record["concurrent"] = True
+        else:
+            # 重置会降低其他线程进行中阶段的峰值，只在没有其他线程的阶段时进行
+            _reset_peak()
+        _active.append(record)
+    start = time.time()
+    begin = time.perf_counter()
+    try:
+        with contextlib.ExitStack() as callbacks:
+            callbacks.enter_context(timer.callback())
+            if _config["progress"] and len(stack) == 1:
+                from dask.diagnostics.progress import ProgressBar
+                callbacks.enter_context(ProgressBar())
+            yield record
+    except BaseException as error:
+        record["error"] = repr(error)
+        raise
+    finally:
+        wall = time.perf_counter() - begin
+        stack.pop()
+        with _lock:
+            _active.remove(record)
+        io_after = _proc_io()
+        peak = max(_peak_rss(), record.pop("_child_peak", 0))
+        if stack:
+            stack[-1]["_child_peak"] = max(stack[-1].get("_child_peak", 0), peak)
+        kernel_seconds = record.pop("_kernel", 0.0)
+        io_seconds = max(sum(timer.seconds.values()) - kernel_seconds, 0.0)
+        if not timer.tasks and kind == "io":
+            io_seconds = wall
+        record.update({
+            "start": start,
+            "wall_seconds": wall,
+            "read_bytes": io_after.get("read_bytes", 0) - io_before.get("read_bytes", 0),
+            "write_bytes": io_after.get("write_bytes", 0) - io_before.get("write_bytes", 0),
+            "rchar": io_after.get("rchar", 0) - io_before.get("rchar", 0),
+            "wchar": io_after.get("wchar", 0) - io_before.get("wchar", 0),
+            "peak_rss": peak,
+            "tasks": timer.tasks,
+            "graph_tasks": timer.graph_tasks,
+            "io_seconds": io_seconds,
+            "kernel_seconds": kernel_seconds,
+            "task_seconds": dict(timer.seconds),
+        })
+        if timer.task_stream:
+            record["task_stream"] = timer.stream
+        with _lock:
+            _records.append(record)
+            if _config["path"] is not None:
+                _append(_config["path"], record, _config["fresh"])
+                _config["fresh"] = False
+
+
+def write_trace(path: str) -> None:
+    """把已完成阶段的全部记录一次写入 .json（数组）或 .csv"""
+    with _lock:
+        _write(path, _records)
@@ -1,39 +1,201 @@
-import xarray as xr
 import numpy as np
-from dask.diagnostics.progress import ProgressBar
 import os
+import math
 from numba import jit
+from ._blocks import apply_block, block_kernel, valid_pixels
+from .instrument import stage
 # import pymannkendall as mk
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
+def _merge_count(keys: np.ndarray, strict: bool):
+    """
+    自底向上归并排序，统计 i<j 且 keys[j]<=keys[i]（strict 时为 <）的逆序对数
+    返回: (逆序对数, 排序后的数组)
+    """
+    n = len(keys)
+    a = keys.copy()
+    b = np.empty_like(a)
+    count = 0
+    width = 1
+    while width < n:
+        for lo in range(0, n, 2 * width):
+            mid = min(lo + width, n)
+            hi = min(lo + 2 * width, n)
+            i = lo
+            j = mid
+            k = lo
+            while i < mid and j < hi:
+                if a[j] < a[i] or (not strict and a[j] == a[i]):
+                    b[k] = a[j]
+                    j += 1
+                    count += mid - i
+                else:
+                    b[k] = a[i]
+                    i += 1
+                k += 1
+            while i < mid:
+                b[k] = a[i]
+                i += 1
+                k += 1
+            while j < hi:
+                b[k] = a[j]
+                j += 1
+                k += 1
+        a, b = b, a
+        width *= 2
+    return count, a
+
+@jit(nopython=True, cache=True)
+def _count_slopes(x: np.ndarray, t: float, strict: bool) -> int:
+    """统计斜率 <= t（strict 时为 < t）的点对数：slope(i,j)<=t 等价于 x[j]-t*j <= x[i]-t*i"""
+    keys = np.empty(len(x))
+    for i in range(len(x)):
+        keys[i] = x[i] - t * i
+    return _merge_count(keys, strict)[0]
+
+@jit(nopython=True, cache=True)
+def _flipped_slopes(x: np.ndarray, t_lo: float, t_hi: float, limit: int):
+    """
+    枚举斜率落在 (t_lo, t_hi] 内的点对：这些点对在 t_lo 与 t_hi 两个投影顺序下恰好互逆
+    返回: (点对数, 随机抽取的一个斜率, 前 limit 个斜率)
+    """
+    n = len(x)
+    a = np.empty(n)
+    b = np.empty(n)
+    for i in range(n):
+        a[i] = x[i] - t_lo * i
+        b[i] = x[i] - t_hi * i
+    # 按 a 升序（a 相同按 b 升序）排列，之后 b 的逆序对即为候选点对
+    order = np.argsort(b, kind="mergesort")
+    order = order[np.argsort(a[order], kind="mergesort")]
+    ids = order.copy()
+    tmp = np.empty_like(ids)
+    slopes = np.empty(limit)
+    count = 0
+    sample = np.nan
+    width = 1
+    while width < n:
+        for lo in range(0, n, 2 * width):
+            mid = min(lo + width, n)
+            hi = min(lo + 2 * width, n)
+            i = lo
+            j = mid
+            k = lo
+            while i < mid and j < hi:
+                if b[ids[j]] <= b[ids[i]]:
+                    q = ids[j]
+                    for l in range(i, mid):
+                        p = ids[l]
+                        if a[q] > a[p]:
+                            u = min(p, q)
+                            v = max(p, q)
+                            s = (x[v] - x[u]) / (v - u)
+                            if count < limit:
+                                slopes[count] = s
+                            count += 1
+                            if np.random.random() * count < 1.0:
+                                sample = s
+                    tmp[k] = q
+                    j += 1
+                else:
+                    tmp[k] = ids[i]
+                    i += 1
+                k += 1
+            while i < mid:
+                tmp[k] = ids[i]
+                i += 1
+                k += 1
+            while j < hi:
+                tmp[k] = ids[j]
+                j += 1
+                k += 1
+        ids, tmp = tmp, ids
+        width *= 2
+    return count, sample, slopes[:min(count, limit)]
+
+@jit(nopython=True, cache=True)
+def _select_slope(x: np.ndarray, k: int) -> float:
+    """
+    在不生成全部 n(n-1)/2 个斜率的前提下，精确选出第 k 小（从0计）的两点斜率
+    先按数值二分缩小区间，并列值过多时改用区间内随机斜率作枢轴，最后只枚举区间内的斜率
+    """
+    n = len(x)
+    xf = x.astype(np.float64)
+    span = xf.max() - xf.min()
+    if span == 0:
+        return 0.0
+    lo = -span - 1.0
+    hi = span + 1.0
+    count_lo = 0
+    count_hi = n * (n - 1) // 2
+    cap = 4 * n + 64
+    for _ in range(64):
+        if count_hi - count_lo <= cap:
+            break
+        mid = 0.5 * (lo + hi)
+        if mid <= lo or mid >= hi:
+            break
+        c = _count_slopes(xf, mid, False)
+        if c <= k:
+            lo = mid
+            count_lo = c
+        else:
+            hi = mid
+            count_hi = c
+    for _ in range(64):
+        if count_hi - count_lo <= cap:
+            break
+        pivot = _flipped_slopes(x, lo, hi, 0)[1]
+        if np.isnan(pivot) or pivot <= lo or pivot > hi:
+            break
+        c = _count_slopes(xf, pivot, False)
+        if c <= k:
+            lo = pivot
+            count_lo = c
+        else:
+            if _count_slopes(xf, pivot, True) <= k:
+                return pivot
+            hi = pivot
+            count_hi = c
+    # 区间两端留出舍入误差余量，保证区间外的点对排序与直接计算的斜率一致
+    scale = np.abs(xf).max()
+    delta = 8 * np.finfo(x.dtype).eps * scale + 64 * np.finfo(xf.dtype).eps * (scale + max(abs(lo), abs(hi)) * n)
+    base = _count_slopes(xf, lo - delta, False)
+    slopes = np.sort(_flipped_slopes(x, lo - delta, hi + delta, n * (n - 1) // 2)[2])
+    r = min(max(k - base, 0), len(slopes) - 1)
+    return slopes[r]
+
+@jit(nopython=True, cache=True)
 def _sens_slope(x: np.ndarray) -> float:
-    """计算Sen's斜率（优化版）"""
+    """计算Sen's斜率：按秩选择中位数，不生成完整斜率数组"""
     n = len(x)
-    slopes = []
-    for i in range(n-1):
-        for j in range(i+1, n):
-            dx = j - i
-            dy = x[j] - x[i]
-            if dx != 0:
-                slopes.append(dy / dx)
-    if len(slopes) == 0:
+    if n < 2:
         return np.nan
-    return float(np.median(np.array(slopes)))
+    total = n * (n - 1) // 2
+    a = _select_slope(x, (total - 1) // 2)
+    if total % 2 == 1:
+        return float(a)
+    b = _select_slope(x, total // 2)
+    return (a + b) / 2
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def _mk_score(x: np.ndarray) -> int:
-    """计算Mann-Kendall S统计量"""
-    s = 0
+    """计算Mann-Kendall S统计量：归并排序统计逆序对，O(n log n)"""
     n = len(x)
-    for k in range(n-1):
-        for j in range(k+1, n):
-            if x[j] > x[k]:
-                s += 1
-            elif x[j] < x[k]:
-                s -= 1
-    return s
-
-@jit(nopython=True)
+    le, sorted_x = _merge_count(x, False)
+    ties = 0
+    current_count = 1
+    for i in range(1, n):
+        if sorted_x[i] == sorted_x[i-1]:
+            current_count += 1
+        else:
+            ties += current_count * (current_count - 1) // 2
+            current_count = 1
+    ties += current_count * (current_count - 1) // 2
+    # S = 同序对 - 逆序对 = (总对数 - 非严格逆序对) - (非严格逆序对 - 并列对)
+    return n * (n - 1) // 2 - 2 * le + ties
+
+@jit(nopython=True, cache=True)
 def _variance_s(x: np.ndarray) -> float:
     """计算方差（兼容ties处理）"""
     n = len(x)
@@ -62,7 +224,7 @@ def _variance_s(x: np.ndarray) -> float:
 
     return (n*(n-1)*(2*n+5) - tie_sum) / 18.0
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def _mk_z(s: int, var_s: float) -> float:
     """计算Z值（修正参数顺序）"""
     if s > 0:
@@ -71,87 +233,260 @@ def _mk_z(s: int, var_s: float) -> float:
         return (s + 1) / np.sqrt(var_s)
     else:
         return 0.0
+
+@jit(nopython=True, cache=True)
+def _rankdata(x: np.ndarray) -> np.ndarray:
+    """平均秩（从1计），与 scipy.stats.rankdata 一致"""
+    n = len(x)
+    order = np.argsort(x, kind="mergesort")
+    ranks = np.empty(n)
+    i = 0
+    while i < n:
+        j = i
+        while j + 1 < n and x[order[j + 1]] == x[order[i]]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[order[k]] = (i + j) / 2 + 1
+        i = j + 1
+    return ranks
+
+@jit(nopython=True, cache=True)
+def _acf(x: np.ndarray, nlags: int) -> np.ndarray:
+    """自相关系数（0~nlags阶），与 pymannkendall 的 __acf 一致；序列为常数时各阶取0"""
+    n = len(x)
+    y = x - x.mean()
+    out = np.zeros(nlags + 1)
+    c0 = np.sum(y * y)
+    out[0] = 1.0
+    if c0 == 0:
+        return out
+    for k in range(1, nlags + 1):
+        out[k] = np.sum(y[:n - k] * y[k:]) / c0
+    return out
+
+@jit(nopython=True, cache=True)
+def _slope_bounds(x: np.ndarray, var_s: float, trusted: float):
+    """Sen's斜率置信区间（Gilbert 1987）：第 M1 与第 M2+1 个斜率，M1,2 = (N ∓ z·sqrt(Var(S)))/2"""
+    n = len(x)
+    total = n * (n - 1) // 2
+    c = trusted * math.sqrt(var_s)
+    lo = min(max(int(round((total - c) / 2)) - 1, 0), total - 1)
+    hi = min(max(int(round((total + c) / 2)), 0), total - 1)
+    return _select_slope(x, lo), _select_slope(x, hi)
+
+MK_METHODS = (
+    "original",
+    "hamed_rao",
+    "yue_wang",
+    "pre_whitening",
+    "trend_free_pre_whitening",
+    "seasonal"
+)
+
+MK_STATS = ("Slope", "Slope-Lower", "Slope-Upper", "S", "Var-S", "Z-score", "P-value", "Tau", "Mask")
+
+@jit(nopython=True, cache=True)
+def _mk_finish(out: np.ndarray, s: float, var_s: float, pairs: float, trusted: float) -> None:
+    z = _mk_z(s, var_s)
+    out[3] = s
+    out[4] = var_s
+    out[5] = z
+    out[6] = math.erfc(abs(z) / math.sqrt(2.0))
+    out[7] = s / pairs
+    out[8] = 1.0 if abs(z) >= trusted else 0.0
+
+@jit(nopython=True, cache=True)
+def _seasonal_test(x: np.ndarray, trusted: float, period: int) -> np.ndarray:
+    """
+    季节性 Mann-Kendall 检验（Hirsch & Slack 1984）：按 period 分季，S、Var(S) 逐季累加，
+    斜率为各季内两点斜率（按年序号计）合并后的中位数；序列末尾不足一个周期的部分视为缺测
+    """
+    out = np.full(9, np.nan)
+    years = (len(x) + period - 1) // period
+    s = 0.0
+    var_s = 0.0
+    pairs = 0.0
+    slopes = np.empty(period * years * (years - 1) // 2)
+    m = 0
+    for c in range(period):
+        column = np.full(years, np.nan)
+        for y in range(years):
+            if y * period + c < len(x):
+                column[y] = x[y * period + c]
+        for i in range(years - 1):
+            if np.isnan(column[i]):
+                continue
+            for j in range(i + 1, years):
+                if not np.isnan(column[j]):
+                    slopes[m] = (column[j] - column[i]) / (j - i)
+                    m += 1
+        valid = column[~np.isnan(column)]
+        if len(valid) < 2:
+            continue
+        s += _mk_score(valid)
+        var_s += _variance_s(valid)
+        pairs += 0.5 * len(valid) * (len(valid) - 1)
+    if m == 0 or var_s == 0:
+        return out
+    slopes = np.sort(slopes[:m])
+    out[0] = np.median(slopes)
+    c = trusted * math.sqrt(var_s)
+    out[1] = slopes[min(max(int(round((m - c) / 2)) - 1, 0), m - 1)]
+    out[2] = slopes[min(max(int(round((m + c) / 2)), 0), m - 1)]
+    _mk_finish(out, s, var_s, pairs, trusted)
+    return out
+
+@jit(nopython=True, cache=True)
+def _mk_test(x: np.ndarray, trusted: float, method: int, lag: int, period: int) -> np.ndarray:
+    """
+    单个像元一次完成检验：返回 Sen's斜率及其置信区间、S、Var(S)、Z、双侧p值、Kendall Tau、显著性掩膜
+    method 为 MK_METHODS 中的序号，修正方法的公式与 pymannkendall 对应函数一致；
+    缺测值先剔除，斜率按剔除后的序号计算；lag 为负时计入全部自相关阶数，为0时不做自相关修正
+    """
+    if method == 5:
+        return _seasonal_test(x, trusted, period)
+    out = np.full(9, np.nan)
+    valid = x[~np.isnan(x)].astype(np.float64)
+    n = len(valid)
+    if n < (2 if method == 0 else 3):
+        return out
+    slope = _sens_slope(valid)
+    var_raw = _variance_s(valid)
+    out[0] = slope
+    if var_raw > 0:
+        out[1], out[2] = _slope_bounds(valid, var_raw, trusted)
+    series = valid
+    if method == 3 or method == 4:
+        # 预白化（Yue & Wang 2002）：去除一阶自相关后重新检验，趋势自由预白化先去趋势再加回
+        trend = slope * np.arange(1, n + 1)
+        base = valid - trend if method == 4 else valid
+        r1 = _acf(base, 1)[1]
+        series = base[1:] - r1 * base[:-1]
+        if method == 4:
+            series = series + trend[:-1]
+    m = len(series)
+    s = _mk_score(series)
+    var_s = _variance_s(series)
+    if method == 1 or method == 2:
+        # 自相关方差修正：Hamed & Rao (1998) 基于去趋势序列的秩，Yue & Wang (2004) 基于去趋势序列本身
+        nlags = n - 1 if lag < 0 else min(lag, n - 1)
+        detrend = valid - slope * np.arange(1, n + 1)
+        if method == 1:
+            acf = _acf(_rankdata(detrend), nlags)
+            bound = trusted / math.sqrt(n)
+            sni = 0.0
+            for i in range(1, nlags + 1):
+                if abs(acf[i]) > bound:
+                    sni += (n - i) * (n - i - 1.0) * (n - i - 2.0) * acf[i]
+            var_s *= 1 + 2 / (n * (n - 1.0) * (n - 2.0)) * sni
+        else:
+            acf = _acf(detrend, nlags)
+            sni = 0.0
+            for i in range(1, nlags + 1):
+                sni += (1 - i / n) * acf[i]
+            var_s *= 1 + 2 * sni
+    if var_s <= 0:
+        return out
+    _mk_finish(out, s, var_s, 0.5 * m * (m - 1), trusted)
+    return out
+
+@block_kernel("float64[:, ::1]", "float64", "int64", "int64", "int64")
+def _mk_block(block: np.ndarray, trusted: float, method: int, lag: int, period: int) -> np.ndarray:
+    out = np.empty((block.shape[0], 9))
+    for i in range(block.shape[0]):
+        out[i] = _mk_test(block[i], trusted, method, lag, period)
+    return out
+
 def mannkendall(
             nc_path: str,
             time_dim: str = "time",  # 增加时间维度参数
             chunks: dict = {"latitude": 100, "longitude": 100},
             var_name: str = 't2m',
             out_dir: str = "./output",
-            trusted: float = 1.96
+            trusted: float = 1.96,
+            method: str = "original",
+            lag: int | None = None,
+            period: int = 12,
+            packed: bool = False,
+            shapefile: str = "",
+            backend: str = "netcdf",
+            compress: str = "LZW",
+            stack: bool = False
         ):
+            """
+            逐像元 Mann-Kendall 趋势检验与 Sen's斜率（含置信区间）
+            参数：
+                trusted : 显著性临界 Z 值（1.96 对应 α=0.05），同时用于斜率置信区间和 Hamed-Rao 的自相关显著性判断
+                method  : 检验方法，取值见 MK_METHODS，对应 pymannkendall 的
+                          original_test、hamed_rao_modification_test、yue_wang_modification_test、
+                          pre_whitening_modification_test、trend_free_pre_whitening_modification_test、seasonal_test
+                lag     : hamed_rao / yue_wang 计入的自相关阶数，与 pymannkendall 相同：为None时取全部阶数
+                          （序列较长时耗时与 n² 成正比），为0时不做自相关修正
+                period  : seasonal 的季节周期（逐月数据为12）
+                packed  : 只把有效像元（非缺测且在区域内）聚成致密数组检验
+                shapefile : 区域矢量文件，给出时区域外像元输出 NaN（隐含 packed）
+                backend : 统计结果的存储格式，"netcdf" 或 "zarr"；输入格式按 nc_path 扩展名自动识别
+                compress : COG 压缩算法，"LZW"、"ZSTD" 或 "DEFLATE"
+                stack   : 另把各项结果写入一个多波段 COG，波段描述为结果名称
+            """
+            # 读写模块（连带 xarray、dask、rioxarray）在调用时才导入，导入本模块只需 numpy 与 numba
+            from .cog import write_cog, write_stack
+            from .store import BACKENDS, open_store, write_store
+            if backend not in BACKENDS:
+                raise ValueError(f"未知的存储格式 {backend}，可选：{', '.join(BACKENDS)}")
+            if method not in MK_METHODS:
+                raise ValueError(f"未知的检验方法 {method}，可选：{', '.join(MK_METHODS)}")
+            if lag is not None and lag < 0:
+                raise ValueError(f"自相关阶数 lag 不能为负数：{lag}")
+
             # 创建输出目录
             os.makedirs(out_dir, exist_ok=True)
 
             # 数据加载
-            with xr.open_dataset(nc_path, chunks=chunks) as ds:
+            with open_store(nc_path, chunks=chunks) as ds:
                 # 维度校验
                 if time_dim not in ds[var_name].dims:
                     raise ValueError(f"时间维度 {time_dim} 不存在于变量 {var_name}")
 
-                # 定义计算函数
-                def _calc_slope(arr: np.ndarray) -> float:
-                    valid = arr[~np.isnan(arr)]
-                    if len(valid) < 2:
-                        return np.nan
-                    return _sens_slope(valid)
-                    # return mk.sens_slope(valid).slope
-
-                def _calc_z(arr: np.ndarray) -> float:
-                    valid = arr[~np.isnan(arr)]
-                    if len(valid) < 2:
-                        return np.nan
-                    s = _mk_score(valid)
-                    var_s = _variance_s(valid)
-                    return _mk_z(s, var_s)
-                    # return mk.original_test(valid).z
-
-                # 并行计算
-                with ProgressBar():
-                    sen_slope = xr.apply_ufunc(
-                        _calc_slope,
-                        ds[var_name],
-                        input_core_dims=[[time_dim]],
-                        dask='parallelized',
-                        vectorize=True,
-                        output_dtypes=[float]
-                    ).compute()
-
-                    z_score = xr.apply_ufunc(
-                        _calc_z,
+                valid = valid_pixels(ds[var_name], time_dim, shapefile) if packed or shapefile else None
+
+                # 单次读取同时得到斜率及置信区间、S、Var(S)、Z、p值、Tau与显著性掩膜
+                with stage("mannkendall", nc_path, method=method):
+                    stats = apply_block(
+                        _mk_block,
                         ds[var_name],
-                        input_core_dims=[[time_dim]],
-                        dask='parallelized',
-                        vectorize=True,
-                        output_dtypes=[float]
-                    ).compute()
+                        time_dim,
+                        args=(float(trusted), MK_METHODS.index(method), -1 if lag is None else int(lag), int(period)),
+                        output_dim="stat",
+                        output_size=len(MK_STATS),
+                        valid=valid
+                    ).assign_coords(stat=list(MK_STATS)).compute()
 
                 # 结果处理
-                significant = sen_slope.where(np.abs(z_score) >= trusted)
-
-                result = xr.Dataset({
-                    "Slope":sen_slope,
-                    "Z-score":z_score,
-                    "Significant":significant
-                })
+                result = stats.to_dataset(dim="stat")
+                result["Significant"] = result["Slope"].where(result["Mask"] == 1)
+                result = result.drop_vars("Mask")
                 base = os.path.basename(nc_path).split('.')[0]
-                result.to_netcdf(os.path.join(out_dir, f"{base}_Slope_MK.nc"))
+                if method != "original":
+                    base = f"{base}_{method}"
+                write_store(result, os.path.join(out_dir, f"{base}_Slope_MK{BACKENDS[backend]}"))
 
                 # 保存结果
-                base = os.path.basename(nc_path).split('.')[0]
-                sen_slope.rio.to_raster(
-                    os.path.join(out_dir, f"{base}_sen.tif"),
-                    dtype='float32',
-                    compress='LZW'
-                )
-                z_score.rio.to_raster(
-                    os.path.join(out_dir, f"{base}_mk_z.tif"),
-                    dtype='float32',
-                    compress='LZW'
-                )
-                significant.rio.to_raster(
-                    os.path.join(out_dir, f"{base}_significant.tif"),
-                    dtype='float32',
-                    compress='LZW'
+                outputs = (
+                    ("Slope", "sen"),
+                    ("Slope-Lower", "sen_lower"),
+                    ("Slope-Upper", "sen_upper"),
+                    ("Z-score", "mk_z"),
+                    ("P-value", "mk_p"),
+                    ("Significant", "significant")
                 )
+                for name, suffix in outputs:
+                    write_cog(result[name], os.path.join(out_dir, f"{base}_{suffix}.tif"), compress)
+                if stack:
+                    write_stack(
+                        {suffix: result[name] for name, suffix in outputs},
+                        os.path.join(out_dir, f"{base}_MK.tif"),
+                        compress
+                    )
 
                 print(f"处理完成！结果保存至：{out_dir}")
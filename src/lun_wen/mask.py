@@ -0,0 +1,108 @@
+import glob
+import hashlib
+import os
+import tempfile
+import numpy as np
+import rioxarray  # 注册 .rio 访问器
+import xarray as xr
+
+SHAPEFILE_PARTS = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+
+
+def _shapefile_hash(shapefile: str) -> str:
+    """按矢量文件及其附属文件的内容计算哈希，文件被修改后缓存自动失效"""
+    digest = hashlib.sha1()
+    stem = os.path.splitext(shapefile)[0]
+    for suffix in SHAPEFILE_PARTS:
+        path = stem + suffix
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _grid_hash(crs, transform, shape: tuple[int, int], all_touched: bool) -> str:
+    """网格签名：(CRS, 仿射变换, 形状)"""
+    key = f"{crs.to_wkt()}|{tuple(transform)[:6]}|{tuple(shape)}|{all_touched}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def region_mask(
+        shapefile: str,
+        crs,
+        transform,
+        shape: tuple[int, int],
+        cache_dir: str | None = None,
+        all_touched: bool = False
+    ) -> np.ndarray:
+    """
+    把矢量区域栅格化为布尔掩膜（True为区域内），结果按位压缩缓存到磁盘
+    同一 (CRS, transform, shape) 网格只栅格化一次，矢量文件或网格变化时重新生成
+    像元判定规则与 rio.clip 一致（默认像元中心落在区域内）
+    参数：
+        shapefile   : 矢量文件路径
+        crs         : 网格坐标系
+        transform   : 网格仿射变换
+        shape       : 网格形状 (行, 列)
+        cache_dir   : 缓存目录，默认为矢量文件所在目录下的 .mask_cache
+        all_touched : 是否计入与区域相交的全部像元
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(shapefile)), ".mask_cache")
+    stem = os.path.splitext(os.path.basename(shapefile))[0]
+    shp_hash = _shapefile_hash(shapefile)[:16]
+    path = os.path.join(cache_dir, f"{stem}-{shp_hash}-{_grid_hash(crs, transform, shape, all_touched)[:16]}.npz")
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            size = int(np.prod(cached["shape"]))
+            return np.unpackbits(cached["bits"], count=size).astype(bool).reshape(cached["shape"])
+
+    # 矢量读取与栅格化只在缓存未命中时需要
+    import pyogrio
+    from rasterio.features import geometry_mask
+    gdf = pyogrio.read_dataframe(shapefile)
+    gdf = gdf.to_crs(crs)
+    mask = geometry_mask(
+        [gdf.geometry.unary_union],
+        out_shape=tuple(shape),
+        transform=transform,
+        invert=True,
+        all_touched=all_touched
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    # 矢量文件已变化的旧缓存直接删除
+    for stale in glob.glob(os.path.join(cache_dir, f"{stem}-*.npz")):
+        if not os.path.basename(stale).startswith(f"{stem}-{shp_hash}-"):
+            os.remove(stale)
+    # 临时文件名各不相同，多个线程或进程同时未命中缓存时互不覆盖，最后一个改名的生效
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(f, bits=np.packbits(mask), shape=np.array(mask.shape))
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return mask
+
+
+def grid_mask(da: xr.DataArray, shapefile: str, cache_dir: str | None = None) -> np.ndarray:
+    """按数据的空间网格取区域掩膜，数据需已写入 CRS"""
+    return region_mask(
+        shapefile,
+        da.rio.crs,
+        da.rio.transform(recalc=True),
+        (da.rio.height, da.rio.width),
+        cache_dir
+    )
+
+
+def mask_window(mask: np.ndarray) -> tuple[slice, slice]:
+    """掩膜的最小外包窗口，与 rio.clip(drop=True) 裁剪后的范围一致"""
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        raise ValueError("掩膜区域与数据范围没有重叠")
+    return slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
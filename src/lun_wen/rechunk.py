@@ -0,0 +1,144 @@
+import argparse
+import itertools
+import math
+import os
+import dask.array as dask_array
+import h5py
+from dask.utils import parse_bytes
+from .store import is_zarr, open_store, preallocate
+
+DEFAULT_TARGET = {"valid_time": -1, "latitude": 64, "longitude": 64}
+
+
+def _slabs(shape: tuple[int, ...], step: tuple[int, ...]):
+    """按 step 遍历数组的全部块，返回各维切片"""
+    ranges = [range(0, n, s) for n, s in zip(shape, step)]
+    for start in itertools.product(*ranges):
+        yield tuple(slice(i, min(i + s, n)) for i, s, n in zip(start, step, shape))
+
+
+def _copy(src, dst, step: tuple[int, ...]) -> None:
+    for region in _slabs(src.shape, step):
+        dst[region] = src[region]
+
+
+def _raw_array(path: str, var: str, mode: str):
+    """按原始编码读写的数组：NetCDF 用 h5py，Zarr 用 zarr"""
+    if is_zarr(path):
+        import zarr
+        return zarr.open_group(path, mode=mode)[var]
+    return h5py.File(path, mode)[var]
+
+
+def _plan(shape, source, target, itemsize: int, max_mem: int):
+    """
+    两阶段重分块方案
+    聚合维（目标分块大于源分块的维，通常为时间）分批读取，其余维按源分块与目标分块的公倍数读取，
+    保证每个源分块只解压一次、每个目标分块只整块写入一次。
+    返回: (第一阶段读取块, 中间文件分块)，整段聚合维可一次放入内存时中间文件分块为None（单阶段）
+    """
+    gather = [t > s for s, t in zip(source, target)]
+    read = [min(n, math.lcm(s, t)) for n, s, t in zip(shape, source, target)]
+    if math.prod(read) * itemsize <= max_mem:
+        return tuple(read), None
+    rest = math.prod(r for r, g in zip(read, gather) if not g) * itemsize
+    if rest * math.prod(s for s, g in zip(source, gather) if g) > max_mem:
+        # 公倍数块放不下时退为目标分块大小读取，源分块会被重复解压
+        read = [t if not g else r for r, t, g in zip(read, target, gather)]
+        rest = math.prod(r for r, g in zip(read, gather) if not g) * itemsize
+    budget = max_mem // rest
+    for i, g in enumerate(gather):
+        if g:
+            # 第一个聚合维尽量取满预算，其余聚合维取源分块
+            read[i] = max(source[i], min(shape[i], budget // source[i] * source[i]))
+            budget = max(1, budget // read[i])
+    intermediate = tuple(r if g else t for r, t, g in zip(read, target, gather))
+    return tuple(read), intermediate
+
+
+def rechunk(
+        source: str,
+        target: str,
+        var: str,
+        target_chunks: dict | None = None,
+        max_mem: int | str = "1GB",
+        temp_dir: str | None = None
+    ) -> None:
+    """
+    磁盘上两阶段重分块：把按时间切片分块的 NetCDF 或 Zarr（如 (1, y, x)、(100, 1024, 1024)）
+    改写为按像元时间序列分块（如 (全部时间, 64, 64)），任何时刻内存不超过 max_mem。
+    先按源分块读取、写入未压缩的中间 HDF5 文件，再按目标分块整块读出并压缩写入，
+    数据按原始编码（scale_factor、_FillValue 等）逐字节复制。
+    参数：
+        source        : 输入 .nc 或 .zarr 路径
+        target        : 输出 .nc 或 .zarr 路径
+        var           : 变量名
+        target_chunks : 目标分块，-1 表示整维，未列出的维保持源分块，默认时间整维、空间64×64
+        max_mem       : 内存预算，字节数或 "1GB" 这样的字符串
+        temp_dir      : 中间文件目录，默认与输出文件相同
+    """
+    max_mem = parse_bytes(max_mem) if isinstance(max_mem, str) else int(max_mem)
+    target_chunks = DEFAULT_TARGET if target_chunks is None else target_chunks
+    with open_store(source, decode_cf=False) as ds:
+        if var not in ds.data_vars:
+            raise ValueError(f"变量 {var} 不存在于 {source}")
+        da = ds[var]
+        shape = da.shape
+        source_chunks = tuple(da.encoding.get("chunksizes") or da.encoding.get("chunks") or shape)
+        chunks = tuple(
+            n if target_chunks.get(dim, s) in (-1, None) else min(int(target_chunks.get(dim, s)), n)
+            for dim, n, s in zip(da.dims, shape, source_chunks)
+        )
+        itemsize = da.dtype.itemsize
+        if math.prod(chunks) * itemsize > max_mem:
+            raise ValueError(f"目标分块 {chunks} 超出内存预算 {max_mem} 字节")
+        read, intermediate = _plan(shape, source_chunks, chunks, itemsize, max_mem)
+
+        # 先写出坐标与属性，数据变量只预分配不写入
+        skeleton = ds.copy()
+        skeleton[var] = da.copy(data=dask_array.empty(shape, dtype=da.dtype, chunks=chunks))
+        encoding = {var: {"chunksizes": chunks, "zlib": True, "complevel": 4, "shuffle": True}}
+        preallocate(skeleton, target, encoding)
+
+    temp = os.path.join(temp_dir or os.path.dirname(os.path.abspath(target.rstrip("/"))), f".{os.path.basename(target.rstrip('/'))}.rechunk.h5")
+    src = _raw_array(source, var, "r")
+    dst = _raw_array(target, var, "r+")
+    try:
+        if intermediate is None:
+            _copy(src, dst, read)
+            return
+        with h5py.File(temp, "w") as tmp:
+            mid = tmp.create_dataset(var, shape=shape, dtype=src.dtype, chunks=intermediate)
+            _copy(src, mid, read)
+            _copy(mid, dst, chunks)
+    finally:
+        for array in (src, dst):
+            if isinstance(array, h5py.Dataset):
+                array.file.close()
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+def _parse_chunks(text: str) -> dict:
+    chunks = {}
+    for item in text.split(","):
+        name, size = item.split("=")
+        chunks[name.strip()] = int(size)
+    return chunks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="把 NetCDF 重分块为按像元时间序列读取的布局")
+    parser.add_argument("source", help="输入 NetCDF 路径")
+    parser.add_argument("target", help="输出 NetCDF 路径")
+    parser.add_argument("--var", default="t2m", help="变量名")
+    parser.add_argument(
+        "--chunks",
+        type=_parse_chunks,
+        default=DEFAULT_TARGET,
+        help="目标分块，如 valid_time=-1,latitude=64,longitude=64"
+    )
+    parser.add_argument("--max-mem", default="1GB", help="内存预算，如 512MB、2GB")
+    parser.add_argument("--temp-dir", default=None, help="中间文件目录")
+    args = parser.parse_args()
+    rechunk(args.source, args.target, args.var, args.chunks, args.max_mem, args.temp_dir)
@@ -0,0 +1,354 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import threading
+import tomllib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+DEFAULT_CONFIG = "pipeline.toml"
+DEFAULT_STATE = "output/pipeline-state.json"
+# 阶段配置中由运行器使用的键，其余键作为参数传给动作
+RESERVED = ("action", "needs", "inputs", "output", "gather")
+# 计算指纹时忽略的未完成文件
+_TEMPORARY = (".part", ".tmp")
+
+
+def _raise_failed(results: dict) -> None:
+    """download_months、ingest 按月份返回异常而不抛出，有失败月份时整个任务视为失败"""
+    failed = [f"{year}-{month:02d}" for (year, month), value in results.items() if isinstance(value, Exception)]
+    if failed:
+        raise RuntimeError(f"{len(failed)} 个月份失败：{', '.join(sorted(failed))}")
+
+
+# 各动作以 (输入路径, 输出路径, **参数) 调用，依赖在调用时才导入
+def _download(source: str | None, output: str, years: list[int], **params) -> None:
+    from .download_data import download_months
+    _raise_failed(download_months([(year, month) for year in years for month in range(1, 13)], out_dir=output, **params))
+
+
+def _ingest(source: str | None, output: str, years: list[int], **params) -> None:
+    from .ingest import ingest
+    _raise_failed(ingest(years, out_dir=output, **params))
+
+
+def _nc_to_tiff(source: str, output: str, **params) -> None:
+    from .translate_data import nc_to_tiff
+    nc_to_tiff(source, output_dir=output, **params)
+
+
+def _tiffs_to_nc(source: str, output: str, var: str, **params) -> None:
+    from .translate_data import tiffs_to_nc
+    tiffs_to_nc(source, output, var, **params)
+
+
+def _etccdi(source: str, output: str, var_name: str, **params) -> None:
+    from .calculate import get_etccdi_stats
+    get_etccdi_stats(source, var_name, output, **params)
+
+
+def _etccdi_cube(source: str | list[str], output: str, var_name: str, **params) -> None:
+    from .calculate import annual_etccdi_cube
+    annual_etccdi_cube(source, var_name, output, **params)
+
+
+def _heatwave(source: str, output: str, **params) -> None:
+    from .calculate import heatwave_metrics
+    heatwave_metrics(source, output, **params)
+
+
+def _tx90p(source: str, output: str, **params) -> None:
+    from .calculate import tx90p_count
+    tx90p_count(source, output, **params)
+
+
+def _organize(source: str, output: str, key_words: list[str], rename: bool = False, **params) -> None:
+    from .file_operation import copy_files_by_keyword
+    from .translate_data import rename_file
+    params.setdefault("fast", True)
+    # 重名文件会追加 _序号，重算前清空各关键字目录，使结果与首次运行相同
+    for keyword in key_words:
+        shutil.rmtree(os.path.join(output, keyword), ignore_errors=True)
+    matched, placed = copy_files_by_keyword(source, output, key_words=key_words, **params)
+    if placed < matched:
+        raise RuntimeError(f"{matched - placed} 个文件分拣失败")
+    if rename:
+        # 与 datetranslate.py 相同：各关键字目录中的文件改名为 {年份}.tif
+        for keyword in key_words:
+            if os.path.isdir(os.path.join(output, keyword)):
+                rename_file(os.path.join(output, keyword))
+
+
+def _mannkendall(source: str, output: str, **params) -> None:
+    from .mannkendall import mannkendall
+    mannkendall(source, out_dir=output, **params)
+
+
+ACTIONS = {
+    "download": _download,
+    "ingest": _ingest,
+    "nc_to_tiff": _nc_to_tiff,
+    "tiffs_to_nc": _tiffs_to_nc,
+    "etccdi": _etccdi,
+    "etccdi_cube": _etccdi_cube,
+    "heatwave": _heatwave,
+    "tx90p": _tx90p,
+    "organize": _organize,
+    "mannkendall": _mannkendall,
+}
+
+
+class _State:
+    """各任务上次成功运行时的指纹，每完成一个任务就原子地写回，中断后已完成的任务不再重算"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def get(self, key: str) -> str | None:
+        with self.lock:
+            return self.entries.get(key)
+
+    def update(self, key: str, fingerprint: str) -> None:
+        with self.lock:
+            self.entries[key] = fingerprint
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f, indent=2, ensure_ascii=False)
+            os.replace(tmp, self.path)
+
+
+def _topological(stages: dict) -> list[str]:
+    """按依赖排序阶段，无依赖关系的阶段保持声明顺序"""
+    order = []
+    visiting = set()
+
+    def _visit(name: str, path: tuple) -> None:
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f"流水线存在循环依赖：{' → '.join(path + (name,))}")
+        visiting.add(name)
+        for need in stages[name].get("needs", []):
+            _visit(need, path + (name,))
+        visiting.discard(name)
+        order.append(name)
+
+    for name in stages:
+        _visit(name, ())
+    return order
+
+
+def load_config(path: str = DEFAULT_CONFIG) -> dict:
+    """
+    读取并校验流水线配置（TOML）。[pipeline] 为全局设置，[stages.名称] 为各阶段：
+        action : 动作名，见 ACTIONS
+        needs  : 依赖的阶段列表，全部成功后才运行
+        inputs : 输入路径或通配符（可为列表），每个匹配的文件或目录为一个任务；省略时整个阶段为一个任务
+        gather : 为 true 时全部匹配的输入作为列表交给同一个任务（如多年文件合成年指数立方体）
+        output : 输出路径，可用 {stem}（输入文件名第一个点之前的部分）和 {name}（输入文件名）
+        其余键 : 传给动作的参数
+    配置中的相对路径相对于当前工作目录
+    参数：
+        path : 配置文件路径
+    返回: {"pipeline": {...}, "stages": {...}, "order": [按依赖排序的阶段名]}
+    """
+    with open(path, "rb") as f:
+        config = tomllib.load(f)
+    pipeline = {"state": DEFAULT_STATE, "trace": None, "works": 2, **config.get("pipeline", {})}
+    stages = config.get("stages", {})
+    if not stages:
+        raise ValueError(f"{path} 中没有 [stages.*] 阶段")
+    for name, spec in stages.items():
+        if spec.get("action") not in ACTIONS:
+            raise ValueError(f"阶段 {name} 的动作 {spec.get('action')} 未知，可选：{', '.join(ACTIONS)}")
+        if "output" not in spec:
+            raise ValueError(f"阶段 {name} 缺少 output")
+        unknown = set(spec.get("needs", [])) - set(stages)
+        if unknown:
+            raise ValueError(f"阶段 {name} 依赖的阶段 {sorted(unknown)} 不存在")
+        if ("inputs" not in spec or spec.get("gather")) and "{" in spec["output"]:
+            raise ValueError(f"阶段 {name} 没有逐个输入的任务，output 中不能使用 {{stem}}、{{name}}")
+    # 不含 {stem}、{name} 的输出按整个目录计入指纹，其中不能再有其他阶段的输出，否则两者的指纹相互影响
+    for name, spec in stages.items():
+        if "{" in spec["output"]:
+            continue
+        own = os.path.abspath(spec["output"])
+        for other, other_spec in stages.items():
+            root = os.path.abspath(other_spec["output"].split("{")[0] or ".")
+            if other != name and os.path.commonpath([own, root]) == own:
+                raise ValueError(f"阶段 {other} 的输出 {other_spec['output']} 位于阶段 {name} 的输出 {spec['output']} 之内")
+    return {"pipeline": pipeline, "stages": stages, "order": _topological(stages)}
+
+
+def _file_stats(path: str) -> list[list]:
+    """文件或目录（递归）中各文件的 [路径, 大小, 修改时间(ns)]"""
+    if os.path.isdir(path):
+        files = sorted(
+            os.path.join(root, file)
+            for root, _, names in os.walk(path)
+            for file in names if not file.endswith(_TEMPORARY)
+        )
+    elif os.path.exists(path):
+        files = [path]
+    else:
+        return []
+    stats = []
+    for file in files:
+        stat = os.stat(file)
+        stats.append([file, stat.st_size, stat.st_mtime_ns])
+    return stats
+
+
+def plan_stage(name: str, spec: dict) -> list[dict]:
+    """
+    按当前文件展开阶段的任务并计算指纹。指纹由动作、参数、输出路径，
+    以及输入与参数中引用的现有文件（如 shapefile）的大小和修改时间得到，任一变化即需重算
+    返回: [{"key", "source", "output", "params", "fingerprint"}, ...]
+    """
+    params = {key: value for key, value in spec.items() if key not in RESERVED}
+    if "inputs" in spec:
+        patterns = spec["inputs"] if isinstance(spec["inputs"], list) else [spec["inputs"]]
+        sources = sorted({path for pattern in patterns for path in glob.glob(pattern)})
+        if spec.get("gather"):
+            sources = [sources] if sources else []
+    else:
+        sources = [None]
+    referenced = {
+        key: _file_stats(value) for key, value in params.items()
+        if isinstance(value, str) and os.path.isfile(value)
+    }
+    jobs = []
+    for source in sources:
+        if source is None or isinstance(source, list):
+            output = spec["output"]
+        else:
+            base = os.path.basename(os.path.normpath(source))
+            output = spec["output"].format(stem=base.split(".")[0], name=base)
+        description = {
+            "action": spec["action"],
+            "params": params,
+            "output": output,
+            "source": None if source is None else [_file_stats(path) for path in source] if isinstance(source, list) else _file_stats(source),
+            "files": referenced,
+        }
+        jobs.append({
+            "key": f"{name}:" if isinstance(source, list) else f"{name}:{source or ''}",
+            "source": source,
+            "output": output,
+            "params": params,
+            "fingerprint": hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest(),
+        })
+    return jobs
+
+
+def _prepare_output(output: str) -> None:
+    """有扩展名的输出（如 .nc、.zarr）创建其上级目录，否则创建输出目录本身"""
+    if os.path.splitext(output)[1]:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    else:
+        os.makedirs(output, exist_ok=True)
+
+
+def _describe(source: str | list[str] | None) -> str:
+    if isinstance(source, list):
+        return f"{source[0]} 等 {len(source)} 个输入" if len(source) > 1 else source[0]
+    return source or ""
+
+
+def _run_stage(name: str, spec: dict, state: _State, force: bool, dry_run: bool) -> dict:
+    """顺序运行阶段中过期的任务，每个任务成功后立即记录指纹"""
+    from .instrument import stage
+    jobs = plan_stage(name, spec)
+    stale = [job for job in jobs if force or state.get(job["key"]) != job["fingerprint"] or not os.path.exists(job["output"])]
+    print(f"[{name}] {len(jobs)} 个任务，{len(stale)} 个需要运行")
+    for job in stale:
+        if dry_run:
+            print(f"[{name}] 将运行 {_describe(job['source'])} → {job['output']}")
+            continue
+        _prepare_output(job["output"])
+        with stage(name, _describe(job["source"]) or job["output"], kind="pipeline", action=spec["action"]):
+            ACTIONS[spec["action"]](job["source"], job["output"], **job["params"])
+        state.update(job["key"], job["fingerprint"])
+    return {"jobs": len(jobs), "ran": 0 if dry_run else len(stale), "stale": len(stale)}
+
+
+def _select(config: dict, targets: list[str] | None) -> list[str]:
+    """目标阶段及其全部上游，按依赖顺序"""
+    if not targets:
+        return list(config["order"])
+    stages = config["stages"]
+    unknown = set(targets) - set(stages)
+    if unknown:
+        raise ValueError(f"阶段 {sorted(unknown)} 不存在，可选：{', '.join(stages)}")
+    selected = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending.extend(stages[name].get("needs", []))
+    return [name for name in config["order"] if name in selected]
+
+
+def run_pipeline(
+        config: dict,
+        targets: list[str] | None = None,
+        works: int | None = None,
+        force: bool = False,
+        dry_run: bool = False,
+        trace: str | None = None
+    ) -> dict:
+    """
+    像 make 一样运行流水线：阶段按 needs 组成有向无环图，依赖全部成功的阶段立即开始，
+    彼此独立的阶段（如 etccdi 与 heatwave）在线程池中同时运行；
+    阶段内每个任务的指纹与状态文件中上次成功时的一致且输出存在时跳过，只重算过期的任务。
+    某阶段失败时其下游阶段跳过，其他分支照常运行
+    参数：
+        config  : load_config 的返回值
+        targets : 只运行这些阶段及其上游，为None时运行全部
+        works   : 同时运行的阶段数，为None时取配置中的 works
+        force   : 忽略指纹全部重算
+        dry_run : 只列出需要运行的任务；下游阶段按现有文件展开，上游尚未生成的输入不计入
+        trace   : 阶段记录逐行追加到的文件（.jsonl 或 .csv），为None时取配置中的 trace
+    返回: {阶段名: {"status": "done" | "failed" | "skipped", "jobs", "ran", "stale", "error"}}
+    """
+    from . import instrument
+    pipeline = config["pipeline"]
+    stages = config["stages"]
+    works = works or pipeline["works"]
+    # 多个阶段同时运行时进度条会相互覆盖，此时不显示
+    instrument.configure(trace or pipeline["trace"], progress=works == 1)
+    state = _State(pipeline["state"])
+    remaining = _select(config, targets)
+    results = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=works) as pool:
+        while remaining or running:
+            # remaining 按依赖排序，一次遍历即可把失败沿下游传播
+            for name in list(remaining):
+                needs = [results.get(need, {}).get("status") for need in stages[name].get("needs", [])]
+                if "failed" in needs or "skipped" in needs:
+                    results[name] = {"status": "skipped"}
+                    remaining.remove(name)
+                    print(f"[{name}] 上游失败，跳过")
+                elif all(status == "done" for status in needs):
+                    running[pool.submit(_run_stage, name, stages[name], state, force, dry_run)] = name
+                    remaining.remove(name)
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    results[name] = {"status": "done", **future.result()}
+                except Exception as error:
+                    results[name] = {"status": "failed", "error": repr(error)}
+                    print(f"[{name}] 失败：{error!r}")
+    return results
@@ -1,40 +1,69 @@
-import glob
-import xarray as xr
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 import os
-import pyogrio
 import numpy as np
-from datetime import datetime, timedelta
-import rioxarray as rxr
-from typing import List
-from dask.diagnostics.progress import ProgressBar
 
-def nc_to_tiff(nc_file:str,shapefile:str="",output_dir:str = "tiffs") -> None:
+def nc_to_tiff(
+        nc_file:str,
+        shapefile:str="",
+        output_dir:str = "tiffs",
+        works:int = 4,
+        time_step:int = 32
+    ) -> None:
     """
     This function converts a NetCDF file to a TIFF file.
-    TIFF影像的Value测量单位是0.1摄氏度
+    TIFF影像的Value测量单位是0.1摄氏度，按 float32 写出
+    裁剪窗口和掩膜由缓存的区域掩膜得到，之后按时间块只读取窗口内数据，
+    逐日 TIFF 由线程池并行写出，内存只与 time_step 和窗口大小有关，与年长度无关
      参数：
          nc_file: 输入的NetCDF文件路径
+         shapefile: 掩膜矢量文件路径，为空时不裁剪
          output_dir: 输出目录路径，默认"tiffs"
+         works: 并行写出线程数
+         time_step: 每次读取的天数
     """
+    # xarray、rioxarray、pyogrio 等依赖在调用时才导入，只用 rename_file 等轻量函数时不付导入开销
+    import pandas as pd
+    from . import store
+    from .instrument import stage
+    from .mask import grid_mask, mask_window
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    with xr.open_dataset(nc_file) as ds:
+    with store.open_store(nc_file, engine=None) as ds:
         ds = ds.rename({"longitude": "lon", "latitude": "lat","valid_time":"time"})
         ds = ds.rio.write_crs("EPSG:4326")
-        ds[list(ds.data_vars)[0]] = np.round((ds[list(ds.data_vars)[0]]-273.15)*10)
+        da = ds[list(ds.data_vars)[0]].transpose("time", "lat", "lon")
+        template = da.isel(time=0, drop=True)
+        mask = None
         if shapefile != "":
-            gdf = pyogrio.read_dataframe(shapefile)
-            gdf = gdf.to_crs(ds.rio.crs)
-            geometry = gdf.geometry.unary_union #读取掩模文件
-            ds = ds.rio.clip([geometry], drop=True) #按掩膜提取
+            # 区域掩膜按网格缓存，同一网格的文件只栅格化一次
+            mask = grid_mask(template, shapefile)
+            ys, xs = mask_window(mask)
+            mask = mask[ys, xs]
+            da = da.isel(lat=ys, lon=xs)
+            template = template.isel(lat=ys, lon=xs)
+        template = template.astype(np.float32).rio.write_nodata(np.nan)
         py_datetime = pd.to_datetime(ds.coords['time'].values)
-        for time_idx, time in enumerate(py_datetime):
-            daily_data = ds[list(ds.data_vars)[0]].isel(time=time_idx)
-            output_dir_year = f"{output_dir}/{time.year}"
-            if not os.path.exists(output_dir_year):
-                os.makedirs(output_dir_year)
-            daily_data.rio.to_raster(f"{output_dir_year}/{time.strftime('%Y%m%d')}.tif")
+        for year in set(py_datetime.year):
+            os.makedirs(f"{output_dir}/{year}", exist_ok=True)
+
+        def _write(values: np.ndarray, time: pd.Timestamp) -> None:
+            template.copy(data=values).rio.to_raster(f"{output_dir}/{time.year}/{time.strftime('%Y%m%d')}.tif")
+
+        pending = []
+        with stage("nc_to_tiff", nc_file, kind="io", files=len(py_datetime)), ThreadPoolExecutor(max_workers=works) as pool:
+            for t0 in range(0, len(py_datetime), time_step):
+                block = np.round((da.isel(time=slice(t0, t0 + time_step)).values - 273.15) * 10).astype(np.float32)
+                if mask is not None:
+                    block[:, ~mask] = np.nan
+                # 读取下一块时上一块仍在写出，最多同时保留两个时间块
+                for future in pending:
+                    future.result()
+                pending = [
+                    pool.submit(_write, values, time)
+                    for values, time in zip(block, py_datetime[t0:t0 + time_step])
+                ]
+            for future in pending:
+                future.result()
 
 def rename_file(input_dir,output_dir=None)->None:
     if output_dir is None:
@@ -55,6 +84,7 @@ def rename_file(input_dir,output_dir=None)->None:
 def tiffs_to_nc(input_dir:str,output_nc:str,var:str,chunks:int| dict =512,bands=False,works:int=4,timeformat:str="%Y%m%d")->None:
     """
     将 TIFF 文件转换为 NetCDF 文件。
+    按日期排序后流式写入，不再构建整体的 concat 计算图，实现见 store.tiffs_to_nc。
     参数：
         input_dir：输入文件夹路径。
         output_nc：输出 NetCDF 文件路径。
@@ -63,55 +93,5 @@ def tiffs_to_nc(input_dir:str,output_nc:str,var:str,chunks:int| dict =512,bands=
         bands：是否包含波段信息。
         works：工作线程数。
     """
-    files = glob.glob(os.path.join(input_dir,"*.tif"))
-    if not files:
-        raise FileNotFoundError(f"未在文件夹 {input_dir} 中找到 TIFF 文件。")
-    xds_array:List[xr.DataArray] = []
-    for _,file in enumerate(files):
-        date_str = os.path.basename(file).split('.')[0]
-        try:
-            date = pd.to_datetime(date_str,format=timeformat)
-        except ValueError:
-            raise ValueError(f"无法解析日期字符串：{date_str}")
-        xds = rxr.open_rasterio(file,chunks=chunks,cache=False)
-        if isinstance(xds,xr.DataArray):
-            xds = xds.astype(np.float32)
-            xds = xds.assign_coords(time=date)
-            if not bands:
-                xds = xds.squeeze('band', drop=True)
-            xds_array.append(xds)
-        else:
-            raise TypeError(f"无法处理数据类型：{type(xds)}")
-    if not xds_array:
-        raise ValueError("未找到有效的数据集或数据数组。")
-    ds = xr.concat(xds_array,dim='time').to_dataset(name=var)
-    ds =ds.rename({'y':'latitude','x':'longitude','time':'valid_time'})
-    ds = ds.where(ds[var] != -9999, other=np.nan)
-    # 设置变量和坐标的属性
-    ds[var].attrs['standard_name'] = var
-    ds[var].attrs['long_name'] = f"Daily Maximum Temperature ({var})"
-    ds[var].attrs['units'] = "0.1°C"
-
-    # 设置全局属性
-    ds.attrs['title'] = "Daily Maximum Temperature Data"
-    ds.attrs['institution'] = "Henan University"
-    ds.attrs['source'] = "Zenodo.org"
-    ds.attrs['history'] = f"Created on {datetime.now().strftime('%Y-%m-%d')}"
-    if isinstance(chunks, dict):
-        chunkSize = (1,chunks['y'],chunks['x'])
-    elif isinstance(chunks,int):
-        chunkSize = (1,chunks,chunks)
-    encoding = {
-            var: {
-                'zlib': True,
-                'complevel': 4,  # 平衡速度与压缩率
-                'chunksizes': chunkSize,
-                'shuffle': True,
-            },
-            'latitude': {'dtype': 'float32'},
-            'longitude': {'dtype': 'float32'},
-            'valid_time': {'dtype': 'float64'}
-        }
-    delayed = ds.to_netcdf(output_nc,encoding=encoding,engine='h5netcdf', compute=False)
-    with ProgressBar():
-        delayed.compute(num_workers=works)
+    from . import store
+    store.tiffs_to_nc(input_dir, output_nc, var, chunks=chunks, bands=bands, works=works, timeformat=timeformat)
@@ -0,0 +1,204 @@
+import json
+import os
+import zlib
+import dask.array as dask_array
+import h5py
+import numpy as np
+import pandas as pd
+import xarray as xr
+from dask.base import tokenize
+
+# HDF5 过滤器编号
+DEFLATE = 1
+SHUFFLE = 2
+FLETCHER32 = 3
+# 复制到虚拟数据集上、供 decode_cf 使用的编码属性
+CF_ATTRS = ("_FillValue", "missing_value", "scale_factor", "add_offset", "units")
+
+
+def _attr(value):
+    """把 HDF5 属性转为可写入 JSON 的 Python 值"""
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, np.ndarray):
+        return value.tolist() if value.size != 1 else value.item()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _chunk_refs(dataset: h5py.Dataset) -> list[list[int]]:
+    """列出已写入分块的 [各维起点..., 过滤器掩码, 字节偏移, 字节数]"""
+    refs = []
+
+    def _collect(info):
+        refs.append([*info.chunk_offset, info.filter_mask, info.byte_offset, info.size])
+
+    if hasattr(dataset.id, "chunk_iter"):
+        dataset.id.chunk_iter(_collect)
+    else:
+        for i in range(dataset.id.get_num_chunks()):
+            _collect(dataset.id.get_chunk_info(i))
+    return refs
+
+
+def _file_entry(path: str, var: str, time_dim: str) -> dict:
+    """读取单个文件的分块位置、过滤器与时间坐标"""
+    with xr.open_dataset(path, engine="h5netcdf") as ds:
+        times = pd.to_datetime(ds[time_dim].values)
+        dims = ds[var].dims
+    with h5py.File(path, "r") as f:
+        dataset = f[var]
+        if dataset.chunks is None:
+            raise ValueError(f"{path} 中的变量 {var} 未分块存储，无法建立分块索引")
+        plist = dataset.id.get_create_plist()
+        filters = [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+        unsupported = set(filters) - {DEFLATE, SHUFFLE, FLETCHER32}
+        if unsupported:
+            raise ValueError(f"{path} 使用了不支持的 HDF5 过滤器 {sorted(unsupported)}")
+        stat = os.stat(path)
+        return {
+            "path": os.path.abspath(path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "dims": list(dims),
+            "shape": list(dataset.shape),
+            "chunks": list(dataset.chunks),
+            "dtype": dataset.dtype.str,
+            "filters": filters,
+            "attrs": {k: _attr(v) for k, v in dataset.attrs.items() if k in CF_ATTRS},
+            "time": [t.isoformat() for t in times],
+            "refs": _chunk_refs(dataset),
+        }
+
+
+def build_index(files: list[str], var: str, index_path: str, time_dim: str = "valid_time") -> dict:
+    """
+    为多个年份文件建立虚拟聚合索引（类似 kerchunk 引用）：记录每个 HDF5 分块在原文件中的字节范围，
+    之后可直接按索引从原文件读取，不再物理合并。索引持久化为 JSON，文件大小或修改时间未变的条目直接复用。
+    参数：
+        files      : NetCDF4/HDF5 文件列表，按时间顺序合并
+        var        : 变量名
+        index_path : 索引 JSON 路径
+        time_dim   : 时间维度名
+    返回: 索引字典
+    """
+    cached = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            old = json.load(f)
+        if old.get("var") == var:
+            cached = {entry["path"]: entry for entry in old["files"]}
+    entries = []
+    for path in files:
+        stat = os.stat(path)
+        entry = cached.get(os.path.abspath(path))
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+            entry = _file_entry(path, var, time_dim)
+        entries.append(entry)
+    entries.sort(key=lambda entry: entry["time"][0])
+    first = entries[0]
+    for entry in entries[1:]:
+        if entry["shape"][1:] != first["shape"][1:] or entry["dims"] != first["dims"]:
+            raise ValueError(f"{entry['path']} 的空间网格与 {first['path']} 不一致")
+
+    # 空间坐标、属性与坐标系取自第一个文件
+    with xr.open_dataset(first["path"], engine="h5netcdf") as ds:
+        da = ds[var]
+        coords = {dim: ds[dim].values.tolist() for dim in first["dims"][1:] if dim in ds.coords}
+        coord_attrs = {dim: ds[dim].attrs for dim in coords}
+        spatial_ref = ds["spatial_ref"].attrs if "spatial_ref" in ds.variables else None
+        attrs = {k: v for k, v in da.attrs.items()}
+    index = {
+        "var": var,
+        "time_dim": time_dim,
+        "coords": coords,
+        "coord_attrs": {dim: {k: _attr(v) for k, v in a.items()} for dim, a in coord_attrs.items()},
+        "spatial_ref": {k: _attr(v) for k, v in spatial_ref.items()} if spatial_ref else None,
+        "attrs": {k: _attr(v) for k, v in attrs.items()},
+        "files": entries,
+    }
+    tmp = f"{index_path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp, index_path)
+    return index
+
+
+def _read_chunk(path: str, offset: int, size: int, filter_mask: int, filters: list[int],
+                dtype: str, chunk: tuple[int, ...], valid: tuple[int, ...], fill) -> np.ndarray:
+    """按字节范围读取并解码一个 HDF5 分块，截去超出数据范围的边缘部分"""
+    if size == 0:
+        return np.full(valid, fill, dtype=dtype)
+    with open(path, "rb") as f:
+        f.seek(offset)
+        raw = f.read(size)
+    dtype = np.dtype(dtype)
+    # 写入时按过滤器顺序编码，读取时逆序解码；掩码置位的过滤器未作用于该分块
+    for i in reversed(range(len(filters))):
+        if filter_mask & (1 << i):
+            continue
+        if filters[i] == DEFLATE:
+            raw = zlib.decompress(raw)
+        elif filters[i] == SHUFFLE:
+            raw = np.frombuffer(raw, np.uint8).reshape(dtype.itemsize, -1).T.tobytes()
+        elif filters[i] == FLETCHER32:
+            raw = raw[:-4]
+    data = np.frombuffer(raw, dtype=dtype).reshape(chunk)
+    return data[tuple(slice(0, n) for n in valid)]
+
+
+def _file_array(entry: dict, name: str) -> dask_array.Array:
+    """由索引条目构造单个文件的 dask 数组，每个 HDF5 分块对应一个任务"""
+    shape = tuple(entry["shape"])
+    chunk = tuple(entry["chunks"])
+    fill = entry["attrs"].get("_FillValue", 0)
+    refs = {tuple(ref[:len(shape)]): ref[len(shape):] for ref in entry["refs"]}
+    chunks = tuple(
+        tuple(min(c, n - start) for start in range(0, n, c))
+        for n, c in zip(shape, chunk)
+    )
+    graph = {}
+    for block in np.ndindex(*[len(c) for c in chunks]):
+        start = tuple(b * c for b, c in zip(block, chunk))
+        valid = tuple(chunks[i][b] for i, b in enumerate(block))
+        filter_mask, offset, size = refs.get(start, (0, 0, 0))
+        graph[(name,) + block] = (
+            _read_chunk, entry["path"], offset, size, filter_mask, entry["filters"],
+            entry["dtype"], chunk, valid, fill
+        )
+    return dask_array.Array(graph, name, chunks, dtype=np.dtype(entry["dtype"]))
+
+
+def open_virtual(index_path: str) -> xr.Dataset:
+    """
+    按索引把多个年份文件打开为一个惰性的 (time, lat, lon) 数据集，数据直接从原文件按字节范围读取
+    参数：
+        index_path : build_index 生成的索引 JSON
+    """
+    with open(index_path) as f:
+        index = json.load(f)
+    var = index["var"]
+    time_dim = index["time_dim"]
+    entries = index["files"]
+    token = tokenize(index_path, [(entry["path"], entry["mtime"]) for entry in entries])
+    coords = {
+        dim: xr.Variable(dim, np.asarray(values), index["coord_attrs"].get(dim))
+        for dim, values in index["coords"].items()
+    }
+    parts = []
+    for i, entry in enumerate(entries):
+        # 各文件的 scale_factor、add_offset 可能不同，逐文件解码后再沿时间拼接
+        attrs = dict(index["attrs"])
+        attrs.update(entry["attrs"])
+        data = _file_array(entry, f"virtual-{var}-{token}-{i}")
+        part = xr.Dataset(
+            {var: xr.Variable(entry["dims"], data, attrs)},
+            coords={time_dim: pd.DatetimeIndex(entry["time"]).as_unit("ns"), **coords}
+        )
+        parts.append(xr.decode_cf(part, decode_times=False)[var])
+    ds = xr.concat(parts, dim=time_dim).to_dataset()
+    if index["spatial_ref"]:
+        ds = ds.assign_coords(spatial_ref=xr.Variable((), 0, index["spatial_ref"]))
+        ds[var].encoding["grid_mapping"] = "spatial_ref"
+    return ds
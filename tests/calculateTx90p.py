@@ -7,7 +7,7 @@ if __name__ == "__main__":
         nc_path="ncs/1km/2003.nc",
         out_dir="output",
         temp_var="t2m",
-        threshold=90,
+        percentile=90,
         chunks={
             "valid_time": -1,
             "latitude": 1024,
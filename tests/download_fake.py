@@ -0,0 +1,186 @@
+import http.server
+import json
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+import xarray as xr
+from lun_wen.download_data import MANIFEST, download_months
+
+
+def netcdf_bytes(value: float) -> bytes:
+    """一个小的、可被 h5netcdf 读取的 NetCDF 文件内容"""
+    ds = xr.Dataset({"t2m": (("latitude", "longitude"), np.full((3, 4), value, dtype=np.float32))})
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "sample.nc")
+        ds.to_netcdf(path, engine="h5netcdf")
+        with open(path, "rb") as f:
+            return f.read()
+
+
+class FakeResult:
+    """代替 cdsapi 的结果对象：location 为 None 时只能通过 download 取回"""
+
+    def __init__(self, content: bytes, content_length: int | None = None, location: str | None = None):
+        self.content = content
+        self.content_length = len(content) if content_length is None else content_length
+        self.location = location
+
+    def download(self, target: str) -> None:
+        time.sleep(0.05)
+        with open(target, "wb") as f:
+            f.write(self.content)
+
+
+class FakeClient:
+    """
+    记录 retrieve 调用次数与最大并发数，按月份依次返回 results 中预设的结果，用完后返回正常文件
+    """
+
+    def __init__(self, results: dict | None = None, delay: float = 0.2):
+        self.results = results or {}
+        self.delay = delay
+        self.calls = []
+        self.running = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        # 作为 client_factory 传入，每次下载尝试各取一个“客户端”
+        return self
+
+    def retrieve(self, dataset: str, request: dict) -> FakeResult:
+        key = (int(request["year"]), int(request["month"]))
+        with self.lock:
+            self.calls.append(key)
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            time.sleep(self.delay)
+            queue = self.results.get(key)
+            if queue:
+                return queue.pop(0)
+            return FakeResult(netcdf_bytes(key[0] + key[1] / 100))
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """只提供一个文件的 HTTP 服务，支持 Range 续传，并记录收到的 Range 头"""
+    content = b""
+    ranges = []
+
+    def do_GET(self):
+        header = self.headers.get("Range")
+        type(self).ranges.append(header)
+        start = int(header.split("=")[1].rstrip("-")) if header else 0
+        body = self.content[start:]
+        self.send_response(206 if header else 200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+if __name__ == "__main__":
+    # 用本地替身代替 CDS 客户端，不访问网络，检查并发下载、按清单跳过与续传、校验失败后重新请求
+    months = [(2021, month) for month in range(1, 7)]
+    with tempfile.TemporaryDirectory() as out_dir:
+        # 1. 并发下载：6 个月、3 个线程，同时进行的请求数应大于1且不超过 works
+        client = FakeClient()
+        results = download_months(months, out_dir, works=3, retries=0, backoff=0, client_factory=client)
+        assert all(results[key] == os.path.join(out_dir, f"{key[0]}_{key[1]}.nc") for key in months), results
+        assert sorted(client.calls) == months, client.calls
+        assert 1 < client.peak <= 3, client.peak
+        for year, month in months:
+            with xr.open_dataset(results[(year, month)], engine="h5netcdf") as ds:
+                assert float(ds["t2m"][0, 0]) == np.float32(year + month / 100)
+        print(f"concurrent   ok  最大并发 {client.peak}")
+
+        # 2. 再次运行：清单中已完成且大小一致的月份全部跳过，不再提交请求
+        client = FakeClient()
+        ready = []
+        results = download_months(months, out_dir, works=3, retries=0, backoff=0, client_factory=client,
+                                  callback=lambda year, month, path: ready.append((year, month)))
+        assert client.calls == [], client.calls
+        assert sorted(ready) == months, ready
+        # 正式文件被截断后不再视为完成，只重新下载该月
+        path = results[(2021, 2)]
+        with open(path, "r+b") as f:
+            f.truncate(100)
+        client = FakeClient()
+        download_months(months, out_dir, works=3, retries=0, backoff=0, client_factory=client)
+        assert client.calls == [(2021, 2)], client.calls
+        print("manifest     ok  已完成月份跳过，截断文件重新下载")
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        # 3. 校验失败后重试：大小不符、内容损坏都丢弃 .part 并重新提交请求，下载不完整时同样重试
+        good = netcdf_bytes(1.0)
+        client = FakeClient({
+            (2022, 1): [FakeResult(good + b"\0" * 16, content_length=len(good))],
+            (2022, 2): [FakeResult(b"\x89HDF" + b"\0" * (len(good) - 4))],
+            (2022, 3): [FakeResult(good[:len(good) // 2], content_length=len(good)),
+                        FakeResult(b"not a netcdf file")],
+        }, delay=0)
+        keys = [(2022, 1), (2022, 2), (2022, 3)]
+        results = download_months(keys, out_dir, works=3, retries=3, backoff=0.01, client_factory=client)
+        assert all(isinstance(results[key], str) for key in keys), results
+        assert sorted(client.calls) == sorted(keys + [(2022, 1), (2022, 2), (2022, 3), (2022, 3)]), client.calls
+        with open(os.path.join(out_dir, MANIFEST)) as f:
+            manifest = json.load(f)
+        for year, month in keys:
+            entry = manifest[f"{year}-{month:02d}"]
+            assert entry["status"] == "done" and entry["error"] is None, entry
+            assert not os.path.exists(os.path.join(out_dir, f"{year}_{month}.nc.part"))
+            with xr.open_dataset(entry["path"], engine="h5netcdf") as ds:
+                assert ds["t2m"].size == 12
+        assert manifest["2022-03"]["attempts"] == 2, manifest["2022-03"]
+        # 重试次数用尽时返回异常，清单记录失败
+        client = FakeClient({(2022, 4): [FakeResult(b"bad")] * 2}, delay=0)
+        results = download_months([(2022, 4)], out_dir, retries=1, backoff=0.01, client_factory=client)
+        assert isinstance(results[(2022, 4)], ValueError), results
+        with open(os.path.join(out_dir, MANIFEST)) as f:
+            assert json.load(f)["2022-04"]["status"] == "failed"
+        print("checksum     ok  校验失败的文件丢弃后重新请求")
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        # 4. 续传：清单中有下载地址且留有 .part 时，按 Range 从已有长度处继续，不重新提交请求
+        content = netcdf_bytes(2.0)
+        RangeHandler.content = content
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            location = f"http://127.0.0.1:{server.server_address[1]}/2023_7.nc"
+            half = len(content) // 2
+            with open(os.path.join(out_dir, "2023_7.nc.part"), "wb") as f:
+                f.write(content[:half])
+            with open(os.path.join(out_dir, MANIFEST), "w") as f:
+                json.dump({"2023-07": {"status": "failed", "location": location, "size": len(content)}}, f)
+            client = FakeClient()
+            results = download_months([(2023, 7)], out_dir, retries=0, backoff=0, client_factory=client)
+            assert client.calls == [], client.calls
+            assert RangeHandler.ranges == [f"bytes={half}-"], RangeHandler.ranges
+            with open(results[(2023, 7)], "rb") as f:
+                assert f.read() == content
+        finally:
+            server.shutdown()
+        print("resume       ok  从 .part 续传")
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        # 5. 取消：退避等待中置位 stop 立即结束并返回本次的异常，尚未开始的月份不再提交请求
+        stop = threading.Event()
+        client = FakeClient({(2024, 1): [FakeResult(b"bad")] * 3}, delay=0)
+        threading.Timer(0.5, stop.set).start()
+        start = time.perf_counter()
+        results = download_months([(2024, 1), (2024, 2)], out_dir, works=1, retries=2, backoff=60,
+                                  client_factory=client, stop=stop)
+        elapsed = time.perf_counter() - start
+        assert elapsed < 5, elapsed
+        assert isinstance(results[(2024, 1)], ValueError), results
+        assert isinstance(results[(2024, 2)], RuntimeError), results
+        assert client.calls == [(2024, 1)], client.calls
+        print(f"cancel       ok  {elapsed:.2f}s 内结束")
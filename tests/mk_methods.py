@@ -0,0 +1,46 @@
+import numpy as np
+import pymannkendall as mk
+from lun_wen.mannkendall import MK_METHODS, MK_STATS, _mk_block
+
+
+if __name__ == "__main__":
+    # 合成带趋势、一阶自相关和并列值（0.1℃取整）的样本像元，与 pymannkendall 逐像元结果对比
+    rng = np.random.default_rng(0)
+    n = 120
+    pixels = np.empty((200, n))
+    for p in range(len(pixels)):
+        noise = np.zeros(n)
+        for t in range(1, n):
+            noise[t] = 0.5 * noise[t - 1] + rng.normal()
+        pixels[p] = np.round(rng.uniform(-0.05, 0.05) * np.arange(n) + noise, 1)
+    pixels[::7, rng.integers(0, n, 5)] = np.nan
+    complete = ~np.isnan(pixels).any(axis=1)
+
+    tests = {
+        "original": lambda x: mk.original_test(x),
+        "hamed_rao": lambda x: mk.hamed_rao_modification_test(x),
+        "yue_wang": lambda x: mk.yue_wang_modification_test(x),
+        "pre_whitening": lambda x: mk.pre_whitening_modification_test(x),
+        "trend_free_pre_whitening": lambda x: mk.trend_free_pre_whitening_modification_test(x),
+        "seasonal": lambda x: mk.seasonal_test(x, period=12),
+    }
+    # 趋势自由预白化序列中会出现仅差舍入误差的近似并列值，个别像元的 S 可能相差1
+    names = ("slope", "s", "var_s", "z", "p", "Tau")
+    columns = [MK_STATS.index(name) for name in ("Slope", "S", "Var-S", "Z-score", "P-value", "Tau")]
+    for method in MK_METHODS:
+        # 修正方法的斜率在缺测时按剔除后的序号计算，与 pymannkendall 按原序号不同，只比较完整像元
+        sample = pixels if method == "seasonal" else pixels[complete]
+        ours = _mk_block(sample, 1.96, MK_METHODS.index(method), -1, 12)[:, columns]
+        ref = np.array([[getattr(tests[method](x), name) for name in names] for x in sample], dtype=float)
+        diff = np.nanmax(np.abs(ours - ref) / np.maximum(np.abs(ref), 1), axis=0)
+        print(f"{method:<26}", "  ".join(f"{name}={d:.1e}" for name, d in zip(names, diff)))
+
+    # 指定自相关阶数：与 pymannkendall 的 lag 含义相同，lag=0 时不做自相关修正
+    modified = {"hamed_rao": mk.hamed_rao_modification_test, "yue_wang": mk.yue_wang_modification_test}
+    sample = pixels[complete]
+    for method, test in modified.items():
+        for lag in (0, 1, 3):
+            ours = _mk_block(sample, 1.96, MK_METHODS.index(method), lag, 12)[:, columns]
+            ref = np.array([[getattr(test(x, lag=lag), name) for name in names] for x in sample], dtype=float)
+            diff = np.nanmax(np.abs(ours - ref) / np.maximum(np.abs(ref), 1), axis=0)
+            print(f"{method + f' lag={lag}':<26}", "  ".join(f"{name}={d:.1e}" for name, d in zip(names, diff)))
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+from lun_wen.calculate import _calendar_layout, _tx90p_block
+
+
+def reference(arr, year_pos, cal_index, doy, base_start, base_end, percentile=90.0, half_window=2):
+    """
+    逐日暴力计算 TX90p：基准期数据排成连续序列，每个日历日取所有基准年 ±half_window 日的值求第8类百分位；
+    基准期内第 k 年依次把序列中第 k 年的数据整体替换为其余基准年的数据，再在替换后的序列上取窗口
+    """
+    nb = base_end - base_start + 1
+    base = np.full((nb, 365), np.nan)
+    for r in range(nb):
+        for d in range(365):
+            if cal_index[base_start + r, d] >= 0:
+                base[r, d] = arr[cal_index[base_start + r, d]]
+
+    def thresholds(series):
+        flat = series.ravel()
+        out = np.empty(365)
+        for d in range(365):
+            idx = np.array([r * 365 + d + o for r in range(nb) for o in range(-half_window, half_window + 1)])
+            values = flat[idx[(idx >= 0) & (idx < flat.size)]]
+            out[d] = np.percentile(values[~np.isnan(values)], percentile, method="median_unbiased")
+        return out
+
+    plain = thresholds(base)
+    swapped = {}
+    for k in range(nb):
+        for i in range(nb):
+            if i != k:
+                series = base.copy()
+                series[k] = base[i]
+                swapped[k, i] = thresholds(series)
+    exceed = np.zeros(cal_index.shape[0])
+    days = np.zeros(cal_index.shape[0])
+    for t, value in enumerate(arr):
+        y, d = year_pos[t], doy[t]
+        k = y - base_start
+        days[y] += 1
+        if 0 <= k < nb and nb > 1:
+            exceed[y] += np.mean([value > swapped[k, i][d] for i in range(nb) if i != k])
+        else:
+            exceed[y] += value > plain[d]
+    return exceed / days * 100
+
+
+if __name__ == "__main__":
+    # 与暴力参考实现对比：基准期含闰年，基准期前后各有一年，数值取整使窗口中有大量并列值
+    rng = np.random.default_rng(0)
+    times = pd.date_range("2000-01-01", "2005-12-31")
+    index = pd.DatetimeIndex(times)
+    # 2月29日沿用2月28日的阈值
+    doy = np.where(index.is_leap_year & (index.dayofyear > 59), index.dayofyear - 2, index.dayofyear - 1)
+    season = 80 * np.sin(2 * np.pi * (index.dayofyear.values - 105) / 365.25)
+    data = np.round(300 + season + rng.normal(0, 40, (4, len(times))))
+    for base_period in ((2001, 2004), (2001, 2003), (2002, 2002)):
+        years, year_pos, cal_index, doy_ptr, doy_steps, base_start, base_end = _calendar_layout(times.values, base_period)
+        got = _tx90p_block(np.ascontiguousarray(data), year_pos, cal_index, doy_ptr, doy_steps, base_start, base_end, 90.0, 2)
+        for pixel in range(len(data)):
+            want = reference(data[pixel], year_pos, cal_index, doy, base_start, base_end)
+            np.testing.assert_allclose(got[pixel], want, rtol=0, atol=1e-9, err_msg=f"{base_period} 像元 {pixel}")
+        print(f"base {base_period[0]}-{base_period[1]}  ok ", " ".join(f"{v:.3f}" for v in got[0]))